@@ -8,13 +8,28 @@ import re
 import requests
 import signal
 import socket
+import struct
 import hashlib
 import shutil
 import random
 import csv
+import heapq
+import math
+import bisect
+import itertools
+import mmap
+import sqlite3
+import ipaddress
 import asyncio
 import pandas as pd
+import openpyxl
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 import threading
+import multiprocessing
+import queue as queue_module
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functools import wraps
 from datetime import datetime, timedelta
 from dateutil import tz
@@ -41,8 +56,15 @@ LOG_FILE = 'fofa_bot.log'
 FOFA_CACHE_DIR = 'fofa_file'
 ANONYMOUS_KEYS_FILE = 'fofa_anonymous.json'
 SCAN_TASKS_FILE = 'scan_tasks.json'
+BATCH_STORES_FILE = 'batch_stores.json'
+KEY_CAPABILITIES_FILE = 'key_capabilities.json'
+HOST_INDEX_DB = 'host_index.db'
+LIVENESS_DB = 'liveness.db'
+COLUMNAR_DIR = os.path.join(FOFA_CACHE_DIR, 'columnar')
+SCAN_STATE_DIR = os.path.join(FOFA_CACHE_DIR, 'scans')
 MAX_HISTORY_SIZE = 50
 MAX_SCAN_TASKS = 50
+MAX_BATCH_STORES = 20
 CACHE_EXPIRATION_SECONDS = 24 * 60 * 60
 MAX_BATCH_TARGETS = 10000
 FOFA_SEARCH_URL = "https://fofa.info/api/v1/search/all"
@@ -121,7 +143,8 @@ STATE_AWAITING_QUERY, STATE_AWAITING_HOST = range(1, 3)
     BATCH_STATE_SELECT_FIELDS,
     BATCH_STATE_MODE_CHOICE,
     BATCH_STATE_GET_LIMIT,
-) = range(50, 53)
+    BATCH_STATE_LOCAL_CHOICE,
+) = range(50, 54)
 
 # /stats, /import, /batchfind, /restore, /batchcheckapi 等独立流程
 (
@@ -136,7 +159,8 @@ STATE_AWAITING_QUERY, STATE_AWAITING_HOST = range(1, 3)
 (
     SCAN_STATE_GET_CONCURRENCY,
     SCAN_STATE_GET_TIMEOUT,
-) = range(100, 102)
+    SCAN_STATE_OPTIONS,
+) = range(100, 103)
 
 # --- 配置管理 & 缓存 ---
 def load_json_file(filename, default_content):
@@ -152,14 +176,23 @@ def load_json_file(filename, default_content):
         logger.error(f"{filename} 损坏，将使用默认配置重建。");
         with open(filename, 'w', encoding='utf-8') as f: json.dump(default_content, f, indent=4); return default_content
 def save_json_file(filename, data):
-    with open(filename, 'w', encoding='utf-8') as f: json.dump(data, f, indent=4, ensure_ascii=False)
+    # 先写入临时文件再原子替换，写到一半中断或多个线程同时保存时不会留下损坏的文件
+    temp_path = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f: json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(temp_path, filename)
 DEFAULT_CONFIG = { "bot_token": "YOUR_BOT_TOKEN_HERE", "apis": [], "admins": [], "proxy": "", "proxies": [], "full_mode": False, "public_mode": False, "presets": [], "update_url": "", "upload_api_url": "", "upload_api_token": "" }
 CONFIG = load_json_file(CONFIG_FILE, DEFAULT_CONFIG)
 HISTORY = load_json_file(HISTORY_FILE, {"queries": []})
 ANONYMOUS_KEYS = load_json_file(ANONYMOUS_KEYS_FILE, {})
 SCAN_TASKS = load_json_file(SCAN_TASKS_FILE, {})
+BATCH_STORES = load_json_file(BATCH_STORES_FILE, {})
+KEY_CAPABILITIES = load_json_file(KEY_CAPABILITIES_FILE, {})
+KEY_CAPABILITIES_LOCK = threading.RLock() # 并发查询的线程也会更新Key能力，读改写与保存都在锁内进行
 def save_config(): save_json_file(CONFIG_FILE, CONFIG)
 def save_anonymous_keys(): save_json_file(ANONYMOUS_KEYS_FILE, ANONYMOUS_KEYS)
+def save_batch_stores(): save_json_file(BATCH_STORES_FILE, BATCH_STORES)
+def save_key_capabilities():
+    with KEY_CAPABILITIES_LOCK: save_json_file(KEY_CAPABILITIES_FILE, KEY_CAPABILITIES)
 def save_scan_tasks():
     logger.info(f"Saving {len(SCAN_TASKS)} scan tasks to {SCAN_TASKS_FILE}")
     save_json_file(SCAN_TASKS_FILE, SCAN_TASKS)
@@ -174,6 +207,7 @@ def add_or_update_query(query_text, cache_data=None):
         HISTORY['queries'].insert(0, new_query)
     while len(HISTORY['queries']) > MAX_HISTORY_SIZE: HISTORY['queries'].pop()
     save_json_file(HISTORY_FILE, HISTORY)
+    if cache_data and cache_data.get('file_path'): schedule_host_indexing(query_text, cache_data['file_path'], 'txt')
 def find_cached_query(query_text):
     query = next((q for q in HISTORY['queries'] if q['query_text'] == query_text), None)
     if query and query.get('cache'):
@@ -219,10 +253,25 @@ def admin_only(func):
             return None
         return func(update, context, *args, **kwargs)
     return wrapped
+# --- 任务停止信号 ---
+# /stop 会设置会话级的 stop_job_{chat_id} (下载任务使用)，并设置本会话中所有已登记任务各自的停止键。
+# 扫描等任务只清除自己登记的键，不会吞掉发给同一会话中其它任务的停止信号。
+def register_stop_key(context: CallbackContext, chat_id, job_name):
+    stop_key = f'stop_job_{chat_id}_{job_name}_{uuid.uuid4().hex[:8]}'
+    context.bot_data.setdefault(f'stop_keys_{chat_id}', set()).add(stop_key)
+    return stop_key
+def release_stop_key(context: CallbackContext, chat_id, stop_key):
+    """任务结束时注销停止键，返回任务期间是否收到过停止信号。"""
+    context.bot_data.get(f'stop_keys_{chat_id}', set()).discard(stop_key)
+    return bool(context.bot_data.pop(stop_key, None))
 def escape_markdown_v2(text: str) -> str:
     if not isinstance(text, str): text = str(text)
     escape_chars = r'_*[]()~`>#+-=|{}.!'
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+def escape_markdown_v2_code(text: str) -> str:
+    """用于 `...` 代码实体内部: 其中只有 \\ 和 ` 需要转义。"""
+    if not isinstance(text, str): text = str(text)
+    return text.replace('\\', '\\\\').replace('`', '\\`')
 def create_progress_bar(percentage: float, length: int = 10) -> str:
     if percentage < 0: percentage = 0
     if percentage > 100: percentage = 100
@@ -311,13 +360,13 @@ def _make_api_request(url, params, timeout=60, use_b64=True, retries=10, proxy_s
             if response.status_code == 429:
                 wait_time = 5 * (attempt + 1)
                 logger.warning(f"FOFA API rate limit hit (429). Retrying in {wait_time} seconds... (Attempt {attempt + 1}/{retries})")
-                time.sleep(wait_time)
+                if attempt + 1 < retries: time.sleep(wait_time)
                 last_error = f"API请求因速率限制(429)失败"
                 continue
             if response.status_code == 502: # Bad Gateway
                 wait_time = 5 * (attempt + 1)
                 logger.warning(f"FOFA API returned 502 Bad Gateway. Retrying in {wait_time} seconds... (Attempt {attempt + 1}/{retries})")
-                time.sleep(wait_time)
+                if attempt + 1 < retries: time.sleep(wait_time)
                 last_error = "API请求失败 (502 Bad Gateway)"
                 continue
             response.raise_for_status()
@@ -328,19 +377,19 @@ def _make_api_request(url, params, timeout=60, use_b64=True, retries=10, proxy_s
         except requests.exceptions.RequestException as e:
             last_error = f"网络请求失败: {e}"
             logger.error(f"RequestException on attempt {attempt + 1}: {e}")
-            time.sleep(5)
+            if attempt + 1 < retries: time.sleep(5)
         except json.JSONDecodeError as e:
             last_error = f"解析JSON响应失败: {e}"
             break
     logger.error(f"API request failed after {retries} retries. Last error: {last_error}")
     return None, last_error if last_error else "API请求未知错误"
 def verify_fofa_api(key): return _make_api_request(FOFA_INFO_URL, {'key': key}, timeout=15, use_b64=False, retries=3)
-def fetch_fofa_data(key, query, page=1, page_size=10000, fields="host", proxy_session=None):
+def fetch_fofa_data(key, query, page=1, page_size=10000, fields="host", proxy_session=None, timeout=60, retries=10):
     query_lower = query.lower()
     if 'body=' in query_lower: page_size = min(page_size, 500)
     elif 'cert=' in query_lower: page_size = min(page_size, 2000)
     params = {'key': key, 'q': query, 'size': page_size, 'page': page, 'fields': fields, 'full': CONFIG.get("full_mode", False)}
-    return _make_api_request(FOFA_SEARCH_URL, params, proxy_session=proxy_session)
+    return _make_api_request(FOFA_SEARCH_URL, params, timeout=timeout, retries=retries, proxy_session=proxy_session)
 def fetch_fofa_stats(key, query, proxy_session=None):
     params = {'key': key, 'q': query, 'fields': FOFA_STATS_FIELDS}
     return _make_api_request(FOFA_STATS_URL, params, proxy_session=proxy_session)
@@ -375,10 +424,60 @@ def check_and_classify_keys():
             elif api_level >= 4: level = 3
             else: level = 1 
         KEY_LEVELS[key] = level
+        record_key_capability(key, level, data, save=False)
         level_name = {0: "免费会员", 1: "个人会员", 2: "商业会员", 3: "企业会员"}.get(level, "未知等级")
         logger.info(f"Key '...{key[-4:]}' ({data.get('username', 'N/A')}) - 等级: {level} ({level_name})")
+    # 已从配置中移除的Key不再保留能力记录
+    current_ids = {_key_capability_id(key) for key in CONFIG.get('apis', [])}
+    with KEY_CAPABILITIES_LOCK:
+        for cap_id in [cap_id for cap_id in KEY_CAPABILITIES if cap_id not in current_ids]: KEY_CAPABILITIES.pop(cap_id)
+        save_key_capabilities()
     logger.info("--- API Keys 分类完成 ---")
 
+# --- Key能力缓存 ---
+# 每个Key实际可用的字段等级以及 lastupdatetime 字段是否可用。
+# 初值来自 verify_fofa_api 的会员等级，之后根据请求的成败修正，持久化到 KEY_CAPABILITIES_FILE，
+# 以Key的哈希为键，重启后无需再次试错。
+KEY_FIELD_DENIED_ERROR = "[820001]"
+
+def _key_capability_id(key): return hashlib.md5(key.encode()).hexdigest()
+
+def _default_key_capability(level):
+    return {'level': level, 'field_level': level, 'lastupdatetime': level >= 1}
+
+def record_key_capability(key, level, verify_data=None, save=True):
+    """用验证结果刷新Key能力: 会员等级变化时丢弃之前学到的限制，否则保留。批量验证时传 save=False，最后统一保存。"""
+    with KEY_CAPABILITIES_LOCK:
+        cap = dict(KEY_CAPABILITIES.get(_key_capability_id(key)) or {})
+        if not cap or cap.get('level') != level: cap = _default_key_capability(level)
+        if verify_data: cap['username'] = verify_data.get('username', '')
+        cap['verified'] = datetime.now(tz.tzutc()).isoformat()
+        KEY_CAPABILITIES[_key_capability_id(key)] = cap
+        if save: save_key_capabilities()
+
+def key_capability(key):
+    return KEY_CAPABILITIES.get(_key_capability_id(key)) or _default_key_capability(max(KEY_LEVELS.get(key, 0), 0))
+
+def learn_key_capability(key, **changes):
+    """记录一次观察到的能力变化(如某等级字段被拒绝)，值与缓存相同时不写盘。"""
+    with KEY_CAPABILITIES_LOCK:
+        cap = dict(key_capability(key))
+        if all(cap.get(name) == value for name, value in changes.items()): return
+        cap.update(changes); KEY_CAPABILITIES[_key_capability_id(key)] = cap; save_key_capabilities()
+    logger.info(f"Key '...{key[-4:]}' 能力已更新: {changes}")
+
+def fetch_with_key_fields(key, query, page_size=100, proxy_session=None):
+    """
+    以该Key已知可用的最高等级字段查询，返回 (data, error, 字段列表)。
+    仍被拒绝([820001])时逐级降低并记住结果，同一个Key以后第一次就会使用正确的字段。
+    """
+    level = key_capability(key)['field_level']
+    while True:
+        fields = get_fields_by_level(level)
+        data, error = fetch_fofa_data(key, query, page_size=page_size, fields=",".join(fields), proxy_session=proxy_session)
+        if error and KEY_FIELD_DENIED_ERROR in str(error) and level > 0: level -= 1; learn_key_capability(key, field_level=level); continue
+        return data, error, fields
+
 def get_fields_by_level(level):
     if level >= 3: return ENTERPRISE_FIELDS
     if level == 2: return BUSINESS_FIELDS
@@ -430,6 +529,43 @@ def execute_query_with_fallback(query_func, preferred_key_index=None, proxy_sess
         
     return None, None, None, None, None, "所有Key均尝试失败 (可能F点均不足)。"
 
+# --- 多Key并发 ---
+FOFA_KEY_MIN_INTERVAL = 1.0 # 同一个Key两次请求之间的最小间隔(秒)
+
+class FofaKeyPool:
+    """
+    线程安全的Key池，供多个线程并发查询。acquire() 取出最早可用的Key并为它预约下一次请求的时间，
+    需要等待时在锁外 sleep，因此请求均匀分散到各个Key上，且单个Key不超过 FOFA_KEY_MIN_INTERVAL 的速率。
+    F点不足的Key会被移出池子，由其它Key接替。
+    """
+    def __init__(self, keys, min_interval=FOFA_KEY_MIN_INTERVAL):
+        self.min_interval, self._lock = min_interval, threading.Lock()
+        self._next_at = {key: 0.0 for key in keys}
+
+    def __len__(self):
+        with self._lock: return len(self._next_at)
+
+    def acquire(self):
+        with self._lock:
+            if not self._next_at: return None
+            key = min(self._next_at, key=self._next_at.get)
+            now = time.monotonic(); start = max(now, self._next_at[key]); self._next_at[key] = start + self.min_interval
+        if start > now: time.sleep(start - now)
+        return key
+
+    def discard(self, key):
+        with self._lock: self._next_at.pop(key, None)
+
+    def query(self, query_func):
+        """按 execute_query_with_fallback 的约定调用 query_func(key, key_level, proxy_session)，返回 (data, error)。"""
+        while True:
+            key = self.acquire()
+            if key is None: return None, "所有Key均尝试失败 (可能F点均不足)。"
+            proxies_list = CONFIG.get("proxies", [])
+            data, error = query_func(key, KEY_LEVELS.get(key, 0), random.choice(proxies_list) if proxies_list else CONFIG.get("proxy"))
+            if error and "[820031]" in str(error): logger.warning(f"Key [...{key[-4:]}] F点余额不足，已移出Key池。"); self.discard(key); continue
+            return data, error
+
 # --- 异步扫描逻辑 ---
 async def async_check_port(host, port, timeout):
     try:
@@ -440,49 +576,685 @@ async def async_check_port(host, port, timeout):
     except (asyncio.TimeoutError, ConnectionRefusedError, OSError, socket.gaierror): return None
     except Exception: return None
 
-async def async_scanner_orchestrator(targets, concurrency, timeout, mode='tcping', progress_callback=None):
-    semaphore = asyncio.Semaphore(concurrency)
-    scan_targets = []
-    if mode == 'tcping':
-        for t in targets:
-            try:
-                host, port_str = t.split(':', 1)
-                scan_targets.append((host, int(port_str)))
-            except (ValueError, IndexError): continue
-    elif mode == 'subnet':
-        subnets_to_ports = {}
-        for line in targets:
-            try:
-                ip_str, port_str = line.strip().split(':'); port = int(port_str)
-                subnet = ".".join(ip_str.split('.')[:3])
-                if subnet not in subnets_to_ports: subnets_to_ports[subnet] = set()
-                subnets_to_ports[subnet].add(port)
-            except ValueError: continue
-        for subnet, ports in subnets_to_ports.items():
-            for i in range(1, 255):
-                for port in ports:
-                    scan_targets.append((f"{subnet}.{i}", port))
-
-    total_tasks = len(scan_targets)
-    completed_tasks = 0
-    
-    async def worker(host, port):
-        nonlocal completed_tasks
-        async with semaphore:
-            result = await async_check_port(host, port, timeout)
-            completed_tasks += 1
-            if progress_callback:
-                await progress_callback(completed_tasks, total_tasks)
-            return result
-
-    tasks = [worker(host, port) for host, port in scan_targets]
-    results = await asyncio.gather(*tasks)
-    return [res for res in results if res is not None]
+# SO_LINGER(1, 0): close 时直接发送 RST，不进入 TIME_WAIT，大规模扫描时不会耗尽本地端口
+_LINGER_RESET = struct.pack('ii', 1, 0)
+
+async def async_check_port_raw(host, port, timeout):
+    """轻量探测: 非阻塞 socket + loop.sock_connect，只判断握手是否成功，不创建 Stream 对象。"""
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, (host, port)), timeout=timeout)
+        return f"{host}:{port}"
+    except (asyncio.TimeoutError, ConnectionRefusedError, OSError, socket.gaierror): return None
+    except Exception: return None
+    finally:
+        try: sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _LINGER_RESET)
+        except OSError: pass
+        sock.close()
+
+SCAN_PROBE_BACKENDS = {'stream': async_check_port, 'raw': async_check_port_raw}
+
+class LivenessCache:
+    """
+    持久化的 (host, port) 存活状态缓存。重复扫描时，TTL 内探测过的目标直接复用上次的结果，
+    只有过期或从未探测的目标才真正发起连接。每次扫描各自持有一个连接，只在一个专用线程中使用:
+    扫描协程通过 run_in_executor 调用 lookup / record_many，sqlite 读写不会阻塞事件循环。
+    """
+    TTL_SECONDS, RETENTION_SECONDS, FLUSH_SIZE = 3600, 7 * 24 * 3600, 500
+
+    def __init__(self, path=LIVENESS_DB, ttl=None):
+        self.ttl = ttl or self.TTL_SECONDS
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS probes (host TEXT NOT NULL, port INTEGER NOT NULL, alive INTEGER NOT NULL, checked_at REAL NOT NULL, PRIMARY KEY (host, port)) WITHOUT ROWID")
+        self.conn.execute("DELETE FROM probes WHERE checked_at < ?", (time.time() - self.RETENTION_SECONDS,)); self.conn.commit()
+
+    def lookup(self, targets):
+        """返回 {(host, port): 是否存活}，只包含 TTL 内的记录。"""
+        wanted = set(targets)
+        hosts = list({host for host, _ in wanted})
+        if not hosts: return {}
+        rows = self.conn.execute(f"SELECT host, port, alive FROM probes WHERE checked_at >= ? AND host IN ({','.join('?' * len(hosts))})", [time.time() - self.ttl] + hosts)
+        return {(host, port): bool(alive) for host, port, alive in rows if (host, port) in wanted}
+
+    def record_many(self, rows):
+        """rows 为 [(host, port, alive, checked_at), ...]，一次提交。"""
+        self.conn.executemany("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)", rows); self.conn.commit()
+
+    def close(self): self.conn.close()
+
+class AsyncResolverCache:
+    """
+    单次扫描内的域名解析缓存: 每个名字只解析一次，并发请求同一名字时共享同一个 Future；
+    同时进行的 getaddrinfo 数量受信号量限制，避免占满默认线程池。解析失败同样缓存为 None。
+    """
+    def __init__(self, max_parallel=64):
+        self._futures, self._semaphore = {}, asyncio.Semaphore(max_parallel)
+
+    def __len__(self): return len(self._futures)
+
+    async def resolve(self, host):
+        try: ipaddress.ip_address(host); return host
+        except ValueError: pass
+        future = self._futures.get(host)
+        if future is None: future = self._futures[host] = asyncio.ensure_future(self._lookup(host))
+        return await future
+
+    async def _lookup(self, host):
+        async with self._semaphore:
+            try: infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            except (OSError, UnicodeError): return None
+        return infos[0][4][0] if infos else None
+
+def scan_group_of(host):
+    """扫描中按目的网络分组的键: IPv4 取所在C段，其它(域名、IPv6)按主机本身。"""
+    parts = host.split('.')
+    return '.'.join(parts[:3]) if len(parts) == 4 and all(p.isdigit() for p in parts) else host
+
+class AdaptiveTimeouts:
+    """
+    按C段记录握手成功的RTT，超时取该段RTT的高分位乘以放大系数，并限制在 [下限, 用户设定] 之间。
+    样本不足的段仍使用用户设定的超时，避免在刚开始时误判。
+    """
+    MIN_SAMPLES, WINDOW, PERCENTILE, MULTIPLIER, FLOOR = 5, 64, 0.95, 4, 0.3
+
+    def __init__(self, max_timeout):
+        self.max_timeout = max_timeout
+        self._rtts, self._timeouts = {}, {}
+
+    def timeout_for(self, host):
+        return self._timeouts.get(scan_group_of(host), self.max_timeout)
+
+    def observe(self, host, rtt):
+        group = scan_group_of(host)
+        samples = self._rtts.setdefault(group, deque(maxlen=self.WINDOW)); samples.append(rtt)
+        # 每积累 MIN_SAMPLES 个新样本重新计算一次分位数
+        if len(samples) >= self.MIN_SAMPLES and len(samples) % self.MIN_SAMPLES == 0:
+            ordered = sorted(samples)
+            high = ordered[int(self.PERCENTILE * (len(ordered) - 1))]
+            self._timeouts[group] = min(self.max_timeout, max(self.FLOOR, high * self.MULTIPLIER))
+
+SUBNET_PREFIX_CHOICES = (24, 23, 22, 20, 16, 30, 28, 26, 25)
+
+def collect_subnet_ports(lines, prefix=24):
+    """
+    用整数运算把 ip:port 行归并到 /prefix 网段。返回 ({网段起始地址整数: {端口}}, 输入中已有的目标集合)。
+    同一网段的多个输入自然合并为一项；非 IPv4 的行(域名、IPv6)无法扩展网段，直接跳过。
+    已有目标以 (ip整数 << 16 | 端口) 存放，扩展时跳过，不再重复探测。
+    """
+    mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+    subnets_to_ports, known_pairs = {}, set()
+    for line in lines:
+        target = normalize_scan_target(line)
+        try: ip_int, port = int(ipaddress.IPv4Address(target[0])), target[1]
+        except (TypeError, ValueError): continue
+        subnets_to_ports.setdefault(ip_int & mask, set()).add(port)
+        known_pairs.add(ip_int << 16 | port)
+    return subnets_to_ports, known_pairs
+
+def _subnet_host_range(base, prefix):
+    """网段内可扫描的主机地址范围，/31 以下不含网络地址和广播地址。"""
+    size = 1 << (32 - prefix)
+    return range(base + 1, base + size - 1) if size > 2 else range(base, base + size)
+
+def count_subnet_targets(subnets_to_ports, prefix=24, known_pairs=()):
+    """与 expand_subnet_targets 生成的目标数一致: 只扣除落在扩展范围内(网段主机 × 该网段端口)的已知目标。"""
+    total = sum(len(_subnet_host_range(base, prefix)) * len(ports) for base, ports in subnets_to_ports.items())
+    mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+    return total - sum(1 for pair in known_pairs if (pair & 0xFFFF) in subnets_to_ports.get((pair >> 16) & mask, ()) and (pair >> 16) in _subnet_host_range((pair >> 16) & mask, prefix))
+
+def expand_subnet_targets(subnets_to_ports, prefix=24, known_pairs=()):
+    """按网段和端口排序后逐个生成 (ip, port)，顺序固定以便断点续扫；输入中已有的目标不再生成。"""
+    for base in sorted(subnets_to_ports):
+        ports = sorted(subnets_to_ports[base])
+        for ip_int in _subnet_host_range(base, prefix):
+            ip_str = socket.inet_ntoa(struct.pack('!I', ip_int))
+            for port in ports:
+                if (ip_int << 16 | port) not in known_pairs: yield (ip_str, port)
+
+SCHEME_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def normalize_scan_target(line):
+    """
+    把缓存中的一行规范化为 (host, port)。支持 host:port、[IPv6]:port 和带协议的 URL (缺省端口按协议补全)，
+    主机名统一小写；无法解析时返回 None。
+    """
+    line = line.strip()
+    if '://' in line:
+        try: parsed = urlparse(line); host, port = parsed.hostname, parsed.port or SCHEME_DEFAULT_PORTS.get(parsed.scheme.lower())
+        except ValueError: return None
+        return (host.lower(), port) if host and port else None
+    if line.startswith('['): host, _, port_str = line[1:].partition(']:')
+    else:
+        host, _, port_str = line.rpartition(':')
+        if ':' in host: return None # 不带方括号的 IPv6 无法区分端口
+    try: port = int(port_str)
+    except ValueError: return None
+    return (host.lower(), port) if host and 0 < port < 65536 else None
+
+def format_scan_target(host, port):
+    return f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+
+SCAN_URL_DEDUPE_WINDOW = 65536 # URL 行之间去重时记住的最近目标数
+
+def iter_scan_targets(lines, line_index=None):
+    """
+    惰性地把缓存行规范化为 (host, port) 扫描目标，lines 可以直接是打开的文件对象。
+    普通 host:port 行在缓存中本身唯一；URL 形式的行可能与它们重复，
+    因此只对 URL 行去重: 已排序缓存中存在同样的 host:port 行，或最近 SCAN_URL_DEDUPE_WINDOW 个 URL 目标中出现过时跳过。
+    缓存有序时同一主机的 URL 行相邻，窗口足以覆盖；窗口外漏掉的重复只会多探测一次。
+    """
+    recent_from_urls = OrderedDict()
+    for line in lines:
+        target = normalize_scan_target(line)
+        if not target: continue
+        if '://' in line:
+            if target in recent_from_urls or (line_index is not None and line_index.contains(format_scan_target(*target))): continue
+            recent_from_urls[target] = None
+            if len(recent_from_urls) > SCAN_URL_DEDUPE_WINDOW: recent_from_urls.popitem(last=False)
+        yield target
+
+# --- 交错目标顺序 ---
+# 顺序扫描时成千上万的并发连接会同时打到同一个C段，容易触发上游限速而丢包。
+# 交错模式用满周期线性同余序列对目标下标做伪随机排列，相邻探测分散到不同网段和端口；
+# 序列只依赖 seed，同一查询每次的顺序相同，断点游标依然有效。
+
+def lcg_permutation(n, seed):
+    """以 O(1) 内存不重复地生成 0..n-1 的一个伪随机排列: 模 2^k 的满周期 LCG，超出 n 的值跳过。"""
+    if n <= 0: return
+    m = 1 << max(2, (n - 1).bit_length())
+    # Hull-Dobell 定理: 模数为2的幂时，增量为奇数且 (乘数-1) 能被4整除即为满周期
+    multiplier = ((0x5DEECE66D ^ seed) & (m - 1) & ~3) | 1
+    increment, x = (int(m * 0.6180339887) ^ seed) & (m - 1) | 1, seed % m
+    for _ in range(m):
+        x = (multiplier * x + increment) % m
+        if x < n: yield x
+
+def expand_subnet_targets_interleaved(subnets_to_ports, prefix=24, known_pairs=(), seed=0):
+    """与 expand_subnet_targets 生成相同的目标集合，但按 lcg_permutation 的顺序，逐个下标定位到网段/主机/端口。"""
+    bases = sorted(subnets_to_ports)
+    port_lists = [sorted(subnets_to_ports[base]) for base in bases]
+    host_ranges = [_subnet_host_range(base, prefix) for base in bases]
+    ends = list(itertools.accumulate(len(hosts) * len(ports) for hosts, ports in zip(host_ranges, port_lists)))
+    for j in lcg_permutation(ends[-1] if ends else 0, seed):
+        k = bisect.bisect_right(ends, j); local = j - (ends[k - 1] if k else 0)
+        ports = port_lists[k]
+        ip_int, port = host_ranges[k][local // len(ports)], ports[local % len(ports)]
+        if (ip_int << 16 | port) not in known_pairs: yield (socket.inet_ntoa(struct.pack('!I', ip_int)), port)
+
+# --- 多端口扫描 ---
+# 按常见程度排序的 TCP 端口(参考 nmap 的端口频率统计)，多端口扫描取前 N 个。
+SWEEP_TOP_PORTS = (80, 23, 443, 21, 22, 25, 3389, 110, 445, 139, 143, 53, 135, 3306, 8080, 1723, 111, 995, 993, 5900,
+                   1025, 587, 8888, 199, 1720, 465, 548, 113, 81, 6001, 10000, 514, 5060, 179, 1026, 2000, 8443, 8000, 32768, 554,
+                   26, 1433, 49152, 2001, 515, 8008, 49154, 1027, 5666, 646, 5000, 5631, 631, 49153, 8081, 2049, 88, 79, 5800, 106,
+                   2121, 1110, 49155, 6000, 513, 990, 5357, 427, 49156, 543, 544, 5101, 144, 7, 389, 8009, 3128, 444, 9999, 5009,
+                   7070, 5190, 3000, 5432, 1900, 3986, 13, 1029, 9, 5051, 6646, 49157, 1028, 873, 1755, 2717, 4899, 9100, 119, 37)
+SWEEP_PORT_CHOICES = (20, 50, 100, 10)
+SWEEP_HIT_LIMIT_CHOICES = (0, 1, 2, 3, 5) # 0 表示不提前结束
+
+def collect_sweep_hosts(lines):
+    """取出缓存中的全部主机，去重后排序；同一主机的多个端口/URL 只保留一次。"""
+    return sorted({host for host, _ in iter_scan_targets(lines)})
+
+def expand_sweep_targets(hosts, ports, interleave=False, seed=0):
+    """
+    端口优先: 先对所有主机探测最常见的端口，再探测下一个端口。开放端口多集中在前几个，
+    结果更早出现，单台主机的探测也被分散到整个扫描过程中；交错模式只打乱每一轮内的主机顺序。
+    """
+    for port in ports:
+        order = lcg_permutation(len(hosts), seed ^ port) if interleave else range(len(hosts))
+        for i in order: yield (hosts[i], port)
+
+def group_sweep_hits(hits):
+    """把 host:port 命中归并为 {host: [端口...]}，端口按数值排序。"""
+    ports_by_host = {}
+    for hit in hits:
+        target = normalize_scan_target(hit)
+        if target: ports_by_host.setdefault(target[0], set()).add(target[1])
+    return {host: sorted(ports) for host, ports in sorted(ports_by_host.items())}
+
+def iter_cache_targets(f, cache_path, interleave=False, seed=0):
+    """顺序读取已打开的缓存文件，或借助行偏移索引按伪随机顺序读取任意行，均无需把文件载入内存。"""
+    with CachedLineIndex(cache_path) as index:
+        lines = (index.line(j) for j in lcg_permutation(len(index), seed)) if interleave else f
+        yield from iter_scan_targets(lines, index)
+
+def count_cache_targets(cache_path, interleave=False, seed=0):
+    """iter_cache_targets 实际产出的目标数(不含无法解析的行和重复的 URL 目标)，按相同顺序遍历一次以保证一致。"""
+    with open(cache_path, 'r', encoding='utf-8') as f: return sum(1 for _ in iter_cache_targets(f, cache_path, interleave, seed))
+
+def _iter_plan_then_rest(plan_path, rest, interleave=False, seed=0):
+    with open(plan_path, 'r', encoding='utf-8') as plan_file:
+        yield from iter_cache_targets(plan_file, plan_path, interleave, seed)
+    if rest is not None: yield from rest
+
+def build_scan_targets(f, cache_path, mode, prefix=24, interleave=False, seed=0, plan_path=None, probe_rest=True, top_ports=SWEEP_PORT_CHOICES[0]):
+    """
+    返回 (目标总数, 目标生成器)，f 为已打开的缓存文件。参数与断点中记录的 spec 一一对应。
+    子网模式给出 plan_path (见 build_smart_subnet_plan) 时先探测计划中的已知资产，probe_rest 决定是否再探测网段其余地址。
+    多端口模式对每台主机探测 SWEEP_TOP_PORTS 中的前 top_ports 个端口。
+    """
+    if mode == 'sweep':
+        hosts, ports = collect_sweep_hosts(f), SWEEP_TOP_PORTS[:top_ports]
+        return len(hosts) * len(ports), expand_sweep_targets(hosts, ports, interleave, seed)
+    if mode == 'subnet':
+        subnets_to_ports, known_pairs = collect_subnet_ports(f, prefix)
+        if plan_path:
+            planned_pairs = set()
+            with open(plan_path, 'r', encoding='utf-8') as plan_file:
+                for host, port in iter_scan_targets(plan_file): planned_pairs.add(int(ipaddress.IPv4Address(host)) << 16 | port)
+            skip_pairs = known_pairs | planned_pairs
+            if not probe_rest: return len(planned_pairs), _iter_plan_then_rest(plan_path, None, interleave, seed)
+            rest = expand_subnet_targets_interleaved(subnets_to_ports, prefix, skip_pairs, seed) if interleave else expand_subnet_targets(subnets_to_ports, prefix, skip_pairs)
+            return len(planned_pairs) + count_subnet_targets(subnets_to_ports, prefix, skip_pairs), _iter_plan_then_rest(plan_path, rest, interleave, seed)
+        expand = expand_subnet_targets_interleaved(subnets_to_ports, prefix, known_pairs, seed) if interleave else expand_subnet_targets(subnets_to_ports, prefix, known_pairs)
+        return count_subnet_targets(subnets_to_ports, prefix, known_pairs), expand
+    return count_cache_targets(cache_path, interleave, seed), iter_cache_targets(f, cache_path, interleave, seed)
+
+async def async_scanner_orchestrator(targets, concurrency, timeout, progress_callback=None, total=0, result_callback=None, backend='stream',
+                                     start_index=0, cursor_callback=None, should_stop=None, adaptive_timeout=False, per_subnet_limit=0,
+                                     liveness_cache=False, stats=None, host_hit_limit=0):
+    """
+    targets 为 (host, port) 的可迭代对象(通常是生成器)，也可以是逐批产出目标列表的异步迭代器(边下载边扫描)。
+    由一个生产者按需取目标放入有界队列，固定 concurrency 个 worker 消费，
+    同一时刻存活的协程和排队的目标数都有上限，内存占用与目标总数无关。
+    传入 result_callback 时命中结果逐条交给回调而不在内存中累积。backend 见 SCAN_PROBE_BACKENDS。
+    start_index 跳过前面已探测的目标；cursor_callback 定期收到"低水位"游标，即该位置之前的目标均已完成；
+    should_stop() 返回真时停止投放新目标，已在途的目标照常完成。
+    adaptive_timeout 为真时按C段的实测RTT收紧超时(见 AdaptiveTimeouts)，timeout 作为上限。
+    per_subnet_limit > 0 时同一C段同时在途的探测数不超过该值。
+    liveness_cache 为真时复用 LivenessCache 中未过期的结果并记录新结果，复用次数写入 stats['cache_hits']。
+    域名目标经 AsyncResolverCache 解析后再探测，命中结果仍以原始主机名输出。
+    host_hit_limit > 0 时同一主机命中达到该数量后跳过它其余的目标(计为已完成，游标不受影响)，跳过数写入 stats['early_stopped']；
+    多进程分片时各分片分别计数。
+    """
+    check_port = SCAN_PROBE_BACKENDS[backend]
+    group_slots = {} # C段 -> [信号量, 等待及使用中的探测数]，无人使用时即删除
+    timeouts = AdaptiveTimeouts(timeout) if adaptive_timeout else None
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    live_results, completed_tasks = [], start_index
+    in_flight, next_index, last_checkpoint = set(), start_index, time.time()
+    # 存活缓存的 sqlite 连接只在这个单线程执行器中使用；新结果攒满 FLUSH_SIZE 条后整批写入
+    db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="liveness") if liveness_cache else None
+    liveness, cache_hits, pending_records, db_writes = None, 0, [], []
+    resolver = AsyncResolverCache()
+    host_hits, early_stopped = {}, 0
+
+    def emit(result):
+        if result_callback: result_callback(result)
+        else: live_results.append(result)
+
+    def low_watermark(): return min(in_flight) if in_flight else next_index
+
+    def write_records():
+        db_writes[:] = [f for f in db_writes if not f.done()]
+        db_writes.append(loop.run_in_executor(db_executor, liveness.record_many, pending_records[:])); pending_records.clear()
+
+    async def probe(host, port, probe_timeout):
+        if not per_subnet_limit: return await check_port(host, port, probe_timeout)
+        group = scan_group_of(host); slot = group_slots.get(group)
+        if slot is None: slot = group_slots[group] = [asyncio.Semaphore(per_subnet_limit), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]: return await check_port(host, port, probe_timeout)
+        finally:
+            slot[1] -= 1
+            if not slot[1]: del group_slots[group]
+
+    async def chunks():
+        if hasattr(targets, '__aiter__'):
+            async for batch in targets:
+                for i in range(0, len(batch), 256): yield batch[i:i + 256]
+            return
+        source = itertools.islice(targets, start_index, None)
+        while True:
+            chunk = list(itertools.islice(source, 256))
+            if not chunk: return
+            yield chunk
+
+    async def producer():
+        nonlocal next_index, completed_tasks, cache_hits
+        async for chunk in chunks():
+            if should_stop and should_stop(): break
+            fresh = await loop.run_in_executor(db_executor, liveness.lookup, chunk) if liveness else {}
+            for target in chunk:
+                index = next_index; next_index += 1
+                alive = fresh.get(target)
+                if alive is not None:
+                    cache_hits += 1; completed_tasks += 1
+                    if alive: emit(format_scan_target(*target)); host_hits[target[0]] = host_hits.get(target[0], 0) + 1
+                    continue
+                in_flight.add(index)
+                await queue.put((index, target))
+            # 缓存命中的目标同样计入进度
+            if fresh and progress_callback: await progress_callback(completed_tasks, total)
+        for _ in range(concurrency): await queue.put(None)
+
+    async def worker():
+        nonlocal completed_tasks, last_checkpoint, early_stopped
+        while True:
+            item = await queue.get()
+            if item is None: return
+            index, (host, port) = item
+            # 取出时才检查命中上限，排队期间刚达到上限的主机也能及时跳过
+            skipped = host_hit_limit and host_hits.get(host, 0) >= host_hit_limit
+            address, result = (None, None) if skipped else (await resolver.resolve(host), None)
+            early_stopped += bool(skipped)
+            if address:
+                started = loop.time()
+                result = await probe(address, port, timeouts.timeout_for(address) if timeouts else timeout)
+                if result and timeouts: timeouts.observe(address, loop.time() - started)
+            if liveness and not skipped:
+                pending_records.append((host, port, int(result is not None), time.time()))
+                if len(pending_records) >= LivenessCache.FLUSH_SIZE: write_records()
+            if result: emit(format_scan_target(host, port)); host_hits[host] = host_hits.get(host, 0) + 1
+            in_flight.discard(index); completed_tasks += 1
+            if progress_callback: await progress_callback(completed_tasks, total)
+            if cursor_callback and time.time() - last_checkpoint > SCAN_CHECKPOINT_INTERVAL:
+                cursor_callback(low_watermark()); last_checkpoint = time.time()
+
+    try:
+        if db_executor: liveness = await loop.run_in_executor(db_executor, LivenessCache)
+        await asyncio.gather(producer(), *(worker() for _ in range(concurrency)))
+    finally:
+        if liveness:
+            if pending_records: write_records()
+            await asyncio.gather(*db_writes, return_exceptions=True); await loop.run_in_executor(db_executor, liveness.close)
+        if db_executor: db_executor.shutdown(wait=False)
+    if cursor_callback: cursor_callback(low_watermark())
+    if stats is not None:
+        stats['cache_hits'] = stats.get('cache_hits', 0) + cache_hits; stats['resolved_names'] = stats.get('resolved_names', 0) + len(resolver)
+        stats['early_stopped'] = stats.get('early_stopped', 0) + early_stopped
+    return live_results
+
+# --- 扫描断点 ---
+# 每个 (查询, 扫描模式) 对应 SCAN_STATE_DIR 下的一对文件:
+# <hash>_<mode>.hits 实时追加命中结果，<hash>_<mode>.json 记录各分片的游标，用于中断后继续。
+SCAN_CHECKPOINT_INTERVAL = 5
+
+def scan_state_paths(query_text, mode):
+    base = os.path.join(SCAN_STATE_DIR, f"{hashlib.md5(query_text.encode()).hexdigest()}_{mode}")
+    return base + '.hits', base + '.json'
+
+def load_scan_checkpoint(query_text, mode):
+    _, state_path = scan_state_paths(query_text, mode)
+    if not os.path.exists(state_path): return None
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f: return json.load(f)
+    except (json.JSONDecodeError, OSError): return None
+
+def save_scan_checkpoint(query_text, mode, state):
+    _, state_path = scan_state_paths(query_text, mode)
+    with open(state_path + '.tmp', 'w', encoding='utf-8') as f: json.dump(state, f)
+    os.replace(state_path + '.tmp', state_path)
+
+def scan_plan_path(query_text, mode):
+    return os.path.join(SCAN_STATE_DIR, f"{hashlib.md5(query_text.encode()).hexdigest()}_{mode}.plan")
+
+def clear_scan_state(query_text, mode):
+    plan_path = scan_plan_path(query_text, mode)
+    for path in scan_state_paths(query_text, mode) + (plan_path, plan_path + LINE_INDEX_EXT):
+        if os.path.exists(path): os.remove(path)
+
+# --- FOFA辅助子网扫描 ---
+# 先从本地倒排索引或 FOFA 查出各网段内已知的 ip:port，写成按行排序的计划文件，扫描时优先探测这些目标。
+SMART_SUBNET_BATCH, SMART_SUBNET_MAX_PAGES = 20, 5
+
+def build_smart_subnet_plan(cache_path, prefix, plan_path, progress_callback=None, source_query=None):
+    """
+    本地索引中有扫描输入以外的 ip:port 的网段直接用索引，其余网段按 SMART_SUBNET_BATCH 个一组合并为
+    ip="x/prefix" || ... 的 FOFA 查询。source_query 为扫描源的查询语句，同一查询的其它缓存(如 /batch 列存)同样排除。
+    返回统计 {'planned', 'local_subnets', 'fofa_subnets', 'errors'}。
+    """
+    with open(cache_path, 'r', encoding='utf-8') as f: subnets_to_ports, known_pairs = collect_subnet_ports(f, prefix)
+    planned, remote_bases, stats = set(), [], {'local_subnets': 0, 'fofa_subnets': 0, 'errors': 0}
+    conn = _host_index_connect() if os.path.exists(HOST_INDEX_DB) else None
+    try:
+        for base in sorted(subnets_to_ports):
+            hosts = _subnet_host_range(base, prefix)
+            # 扫描源自身及同一查询的其它缓存也在索引中，必须排除；其它缓存(重叠的下载、/union 结果)只含输入中已有的目标时
+            # 同样不算本地已有，否则这些网段既不查 FOFA 也没有计划目标
+            rows = conn.execute("SELECT DISTINCT p.ip, p.port FROM postings p JOIN sources s ON s.id = p.source_id WHERE p.ip BETWEEN ? AND ? AND p.port IS NOT NULL AND s.path != ? AND s.query != ?",
+                                (hosts.start, hosts.stop - 1, cache_path, source_query or "")).fetchall() if conn else []
+            local_pairs = {ip << 16 | port for ip, port in rows} - known_pairs
+            if local_pairs: planned.update(local_pairs); stats['local_subnets'] += 1
+            else: remote_bases.append(base)
+    finally:
+        if conn: conn.close()
+    for i in range(0, len(remote_bases), SMART_SUBNET_BATCH):
+        chunk = remote_bases[i:i + SMART_SUBNET_BATCH]
+        if progress_callback: progress_callback(i, len(remote_bases))
+        query_text = " || ".join(f'ip="{ipaddress.IPv4Network((base, prefix))}"' for base in chunk)
+        for page in range(1, SMART_SUBNET_MAX_PAGES + 1):
+            data, _, _, _, _, error = execute_query_with_fallback(
+                lambda key, key_level, proxy_session: fetch_fofa_data(key, query_text, page, 10000, "ip,port", proxy_session=proxy_session)
+            )
+            if error: logger.warning(f"FOFA辅助子网查询失败: {error}"); stats['errors'] += 1; break
+            results = data.get('results', [])
+            for row in results:
+                try: planned.add(int(ipaddress.IPv4Address(row[0])) << 16 | int(row[1]))
+                except (ValueError, IndexError, TypeError): continue
+            if len(results) < 10000: break
+        stats['fofa_subnets'] += len(chunk)
+    mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+    planned = [pair for pair in planned - known_pairs if ((pair >> 16) & mask) in subnets_to_ports and (pair >> 16) in _subnet_host_range((pair >> 16) & mask, prefix)]
+    stats['planned'] = write_cache_lines(plan_path, sorted(format_scan_target(socket.inet_ntoa(struct.pack('!I', pair >> 16)), pair & 0xFFFF) for pair in planned))
+    return stats
+
+def scan_global_cursor(cursors):
+    """把各分片的本地游标换算为全局游标: 该位置之前的目标在所有分片中都已完成。"""
+    shard_count = len(cursors)
+    return min(cursor * shard_count + i for i, cursor in enumerate(cursors)) if cursors else 0
+
+def shard_start_index(global_cursor, shard_index, shard_count):
+    """分片 i 取全局下标 i, i+n, i+2n...，返回其中第一个不小于 global_cursor 的本地序号。"""
+    return max(0, -(-(global_cursor - shard_index) // shard_count))
+
+# --- 多进程分片扫描 ---
+# 每个子进程按步长 (第 shard_index 个起，每 shard_count 个取一个) 从同一个缓存文件中取目标，
+# 运行自己的事件循环和并发份额，进度、命中与游标通过队列回传给主进程中的任务线程。
+SCAN_PROGRESS_INTERVAL = 0.5
+
+def _scan_shard_worker(cache_path, mode, shard_index, shard_count, concurrency, timeout, events, start_index=0, stop_event=None, target_spec=None, probe_options=None):
+    """子进程入口，必须是模块级函数以便在 spawn 模式下被 pickle。target_spec 传给 build_scan_targets，probe_options 传给编排器。"""
+    completed, last_report = start_index, 0
+
+    async def report(done, total):
+        nonlocal completed, last_report
+        completed = done
+        if time.time() - last_report > SCAN_PROGRESS_INTERVAL: events.put(('progress', shard_index, done)); last_report = time.time()
+
+    stats = {}
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        _, targets = build_scan_targets(f, cache_path, mode, **(target_spec or {}))
+        asyncio.run(async_scanner_orchestrator(
+            itertools.islice(targets, shard_index, None, shard_count), concurrency, timeout, report, result_callback=lambda hit: events.put(('hit', shard_index, hit)),
+            start_index=start_index, cursor_callback=lambda cursor: events.put(('cursor', shard_index, cursor)),
+            should_stop=stop_event.is_set if stop_event else None, stats=stats, **(probe_options or {})))
+    events.put(('stats', shard_index, stats))
+    events.put(('done', shard_index, completed))
+
+def run_sharded_scan(cache_path, mode, concurrency, timeout, progress_callback=None, total=0,
+                     start_cursor=0, result_callback=None, cursor_callback=None, should_stop=None, target_spec=None, probe_options=None, stats=None):
+    """
+    把扫描分片到 CPU 核数个进程上；progress_callback(completed, total) 与其它回调都在当前线程中调用。
+    start_cursor 与 cursor_callback 使用全局游标，因此分片数变化后仍可继续之前的扫描。
+    """
+    shard_count = max(1, min(os.cpu_count() or 1, concurrency))
+    mp_context = multiprocessing.get_context('spawn')
+    events, stop_event = mp_context.Queue(), mp_context.Event()
+    starts = [shard_start_index(start_cursor, i, shard_count) for i in range(shard_count)]
+    processes = [mp_context.Process(target=_scan_shard_worker, args=(cache_path, mode, i, shard_count, max(1, concurrency // shard_count), timeout, events, starts[i], stop_event, target_spec, probe_options), daemon=True) for i in range(shard_count)]
+    for process in processes: process.start()
+    live_results, shard_progress, cursors, finished = [], list(starts), list(starts), set()
+    try:
+        while len(finished) < shard_count:
+            if should_stop and should_stop(): stop_event.set()
+            try: kind, shard_index, payload = events.get(timeout=1)
+            except queue_module.Empty:
+                # 子进程异常退出时不会发送 done，按已退出处理以免永远等待
+                finished.update(i for i, process in enumerate(processes) if process.exitcode not in (None, 0))
+                continue
+            if kind == 'hit':
+                if result_callback: result_callback(payload)
+                else: live_results.append(payload)
+                continue
+            if kind == 'stats':
+                if stats is not None:
+                    for key, value in payload.items(): stats[key] = stats.get(key, 0) + value
+                continue
+            if kind == 'cursor':
+                cursors[shard_index] = payload
+                if cursor_callback: cursor_callback(scan_global_cursor(cursors))
+                continue
+            shard_progress[shard_index] = payload
+            if kind == 'done': finished.add(shard_index)
+            if progress_callback: progress_callback(sum(shard_progress), total)
+    finally:
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive(): process.terminate()
+    return live_results
+
+class ScanProgressReporter:
+    """
+    扫描进度汇报线程。扫描端(事件循环或分片汇总线程)只调用 update() 向线程安全队列投递计数，
+    由本线程负责计算速率/剩余时间并同步调用 Telegram 接口，事件循环不会被网络请求阻塞。
+    """
+    RATE_WINDOW_SECONDS = 10
+
+    def __init__(self, msg, title, interval=2):
+        self.msg, self.title, self.interval = msg, title, interval
+        self._queue, self._last_put = queue_module.Queue(), 0
+        self._samples = deque()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start(); return self
+
+    def update(self, completed, total):
+        now = time.monotonic()
+        if now - self._last_put < 0.2 and completed < total: return
+        self._queue.put_nowait((now, completed, total)); self._last_put = now
+
+    def close(self):
+        self._queue.put(None); self._thread.join(timeout=10)
+
+    def _render(self, completed, total):
+        samples = self._samples
+        rate = (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0]) if len(samples) > 1 and samples[-1][0] > samples[0][0] else 0
+        eta = str(timedelta(seconds=int((total - completed) / rate))) if rate > 0 and total > completed else "--"
+        return (f"{self.title}\n{create_progress_bar(min(completed / total, 1) * 100 if total else 0)} ({completed}/{total})\n"
+                f"速率: {rate:,.0f} 次/秒 | 预计剩余: {eta}")
+
+    def _run(self):
+        latest, last_edit = None, 0
+        while True:
+            try: item = self._queue.get(timeout=self.interval)
+            except queue_module.Empty: continue
+            if item is None: return
+            latest = item; self._samples.append(item[:2])
+            while self._samples and item[0] - self._samples[0][0] > self.RATE_WINDOW_SECONDS: self._samples.popleft()
+            if item[0] - last_edit >= self.interval:
+                try: self.msg.edit_text(self._render(latest[1], latest[2])); last_edit = item[0]
+                except (BadRequest, RetryAfter, TimedOut, NetworkError): pass # 汇报失败不影响扫描
+
+class DownloadScanPipeline:
+    """
+    边下载边扫描。下载任务线程调用 feed() 提交每页新出现的 host，独立线程中的事件循环通过有界 asyncio 队列
+    逐批交给 async_scanner_orchestrator；扫描跟不上时 feed() 会阻塞，对下载形成背压。
+    存活结果只写入文件，内存中仅保留用于滚动显示的最新几条；提交去重只记住最近 DEDUPE_WINDOW 个目标，
+    窗口外的重复目标至多多探测一次，最终结果在发送前外部排序去重。
+    """
+    QUEUE_BATCHES, CONCURRENCY, TIMEOUT, REPORT_INTERVAL, DEDUPE_WINDOW = 8, 500, 2, 3, 200000
+
+    def __init__(self, context, chat_id, query_text):
+        self.context, self.chat_id, self.query_text = context, chat_id, query_text
+        self.hits_path, _ = scan_state_paths(query_text, 'pipeline')
+        self.fed, self.completed, self.hit_count, self.latest_hits, self._recent = 0, 0, 0, deque(maxlen=5), OrderedDict()
+        self._stopping, self._ready, self._last_report = False, threading.Event(), 0
+        self.msg = context.bot.send_message(chat_id, "🛰️ 边下载边扫描已启动，新结果会在下载的同时进行TCP存活探测...")
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._main()), daemon=True)
+
+    def start(self):
+        self._thread.start(); self._ready.wait(10); return self
+
+    async def _main(self):
+        self._loop, self._batches = asyncio.get_running_loop(), asyncio.Queue(maxsize=self.QUEUE_BATCHES)
+        self._ready.set()
+
+        async def batches():
+            while True:
+                batch = await self._batches.get()
+                if batch is None: return
+                yield batch
+
+        async def progress(done, total): self.completed = done
+
+        with open(self.hits_path, 'w', encoding='utf-8') as hits_file:
+            def on_hit(hit): hits_file.write(hit + "\n"); hits_file.flush(); self.hit_count += 1; self.latest_hits.append(hit)
+            await async_scanner_orchestrator(batches(), self.CONCURRENCY, self.TIMEOUT, progress, result_callback=on_hit, backend='raw', should_stop=lambda: self._stopping)
+
+    def feed(self, hosts):
+        batch = []
+        for host in hosts:
+            target = normalize_scan_target(host)
+            if not target or target in self._recent: continue
+            self._recent[target] = None; batch.append(target)
+            if len(self._recent) > self.DEDUPE_WINDOW: self._recent.popitem(last=False)
+        if batch and self._thread.is_alive():
+            self.fed += len(batch)
+            asyncio.run_coroutine_threadsafe(self._batches.put(batch), self._loop).result()
+        self._report()
+
+    def _report(self, force=False):
+        if not force and time.time() - self._last_report < self.REPORT_INTERVAL: return
+        latest = "\n".join(self.latest_hits)
+        try: self.msg.edit_text(f"🛰️ 边下载边扫描: 已提交 {self.fed} | 已探测 {self.completed} | 存活 {self.hit_count}" + (f"\n最新存活:\n{latest}" if latest else ""))
+        except (BadRequest, RetryAfter, TimedOut, NetworkError): pass
+        self._last_report = time.time()
+
+    def _close_feed(self):
+        try: self._batches.put_nowait(None)
+        except asyncio.QueueFull: pass # 队列已满说明生产者没有在等待，它会在取下一批前看到停止标志
+
+    def finish(self, stopped=False):
+        """下载结束后调用: 正常结束时等待剩余目标探测完毕，停止时只等待在途探测；然后发送存活结果。"""
+        if self._thread.is_alive():
+            if stopped: self._stopping = True; self._loop.call_soon_threadsafe(self._close_feed)
+            else: asyncio.run_coroutine_threadsafe(self._batches.put(None), self._loop).result()
+            self._thread.join()
+        self._report(force=True)
+        if self.hit_count:
+            ensure_sorted_cache(self.hits_path) # 分块外部排序并去重，内存占用与命中数无关
+            output_filename = generate_filename_from_query(self.query_text, prefix="pipeline_scan")
+            hit_total = write_cache_lines(output_filename, _iter_sorted_unique(self.hits_path))
+            caption = f"🛰️ *边下载边扫描{'已停止' if stopped else '完成'}*\n\n共探测 *{self.completed}* 个目标, 发现 *{hit_total}* 个存活\\."
+            send_file_safely(self.context, self.chat_id, output_filename, caption=caption, parse_mode=ParseMode.MARKDOWN_V2)
+            upload_and_send_links(self.context, self.chat_id, output_filename)
+            os.remove(output_filename); os.remove(output_filename + LINE_INDEX_EXT)
+        for path in (self.hits_path, self.hits_path + LINE_INDEX_EXT):
+            if os.path.exists(path): os.remove(path)
+
+def start_download_pipeline(context, job_data, query_text):
+    """下载任务开始时调用，仅在用户以 --scan 发起查询时启用边下载边扫描。"""
+    return DownloadScanPipeline(context, job_data['chat_id'], query_text).start() if job_data.get('pipeline_scan') else None
 
 def run_async_scan_job(context: CallbackContext):
     job_context = context.job.context
     chat_id, msg, original_query, mode = job_context['chat_id'], job_context['msg'], job_context['original_query'], job_context['mode']
-    concurrency, timeout = job_context['concurrency'], job_context['timeout']
+    concurrency, timeout, options = job_context['concurrency'], job_context['timeout'], job_context.get('options', {})
+    prefix = options.get('prefix', 24)
+    # 决定目标集合及其顺序的参数(记入断点)与只影响探测方式的参数分开传递
+    target_spec = {'prefix': prefix, 'interleave': bool(options.get('interleave')), 'seed': int(hashlib.md5(original_query.encode()).hexdigest()[:12], 16)}
+    if mode == 'subnet' and options.get('smart_subnet'): target_spec.update(plan_path=scan_plan_path(original_query, mode), probe_rest=bool(options.get('probe_rest')))
+    if mode == 'sweep': target_spec['top_ports'] = options.get('top_ports', SWEEP_PORT_CHOICES[0])
+    probe_options = {'backend': 'raw' if options.get('raw_probe') else 'stream', 'adaptive_timeout': bool(options.get('adaptive_timeout')),
+                     'per_subnet_limit': SCAN_PER_SUBNET_LIMIT if options.get('subnet_cap') else 0, 'liveness_cache': bool(options.get('liveness_cache')),
+                     'host_hit_limit': options.get('hit_limit', 0)}
+    scan_stats = {}
     
     cached_item = find_cached_query(original_query)
     if not cached_item:
@@ -492,47 +1264,66 @@ def run_async_scan_job(context: CallbackContext):
 
     try: msg.edit_text("1/3: 正在读取本地缓存文件...")
     except (BadRequest, RetryAfter, TimedOut): pass
+
+    scan_type_text = {'tcping': "TCP存活扫描", 'subnet': f"子网扫描(/{prefix})", 'sweep': f"多端口扫描(Top {target_spec.get('top_ports')})"}[mode]
     
+    reporter = ScanProgressReporter(msg, f"2/3: 正在进行异步{scan_type_text}...")
+
+    async def progress_callback(completed, total): reporter.update(completed, total)
+
+    def announce(total, workers_text=""):
+        try: msg.edit_text(f"2/3: 已加载 {total} 个目标，开始异步{scan_type_text} (并发: {concurrency}, 超时: {timeout}s{workers_text})...")
+        except (BadRequest, RetryAfter, TimedOut): pass
+
+    cache_path = cached_item['cache']['file_path']
+    hits_path, _ = scan_state_paths(original_query, mode)
+    stop_flag = register_stop_key(context, chat_id, 'scan')
     try:
-        with open(cached_item['cache']['file_path'], 'r', encoding='utf-8') as f:
-            targets = [line.strip() for line in f if ':' in line.strip()]
-    except Exception as e:
+        checkpoint = load_scan_checkpoint(original_query, mode) if options.get('resume') else None
+        if not checkpoint or checkpoint.get('spec') != target_spec: checkpoint = None; clear_scan_state(original_query, mode)
+        plan_path = target_spec.get('plan_path')
+        if plan_path and not os.path.exists(plan_path):
+            def plan_progress(done, total):
+                try: msg.edit_text(f"1/3: 正在查询各网段的已知资产 (FOFA 网段 {done}/{total})...")
+                except (BadRequest, RetryAfter, TimedOut): pass
+            plan_stats = build_smart_subnet_plan(cache_path, prefix, plan_path, plan_progress, original_query)
+            scan_stats['plan_text'] = f"\n🧭 FOFA辅助: {plan_stats['local_subnets']} 个网段使用本地索引, {plan_stats['fofa_subnets']} 个网段查询FOFA, 已知资产 {plan_stats['planned']} 个优先探测。"
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            total, targets = build_scan_targets(f, cache_path, mode, **target_spec)
+            start_cursor = checkpoint['cursor'] if checkpoint and checkpoint.get('total') == total else 0
+
+            def save_cursor(cursor):
+                save_scan_checkpoint(original_query, mode, {'query': original_query, 'mode': mode, 'total': total, 'spec': target_spec, 'cursor': cursor, 'updated': time.time()})
+
+            with open(hits_path, 'a' if start_cursor else 'w', encoding='utf-8') as hits_file:
+                def record_hit(hit): hits_file.write(hit + "\n"); hits_file.flush()
+                should_stop = lambda: context.bot_data.get(stop_flag, False)
+                resumed_text = f", 从第 {start_cursor} 个继续" if start_cursor else ""
+                reporter.start()
+                try:
+                    if options.get('multiprocess'):
+                        announce(total, f", 进程: {max(1, min(os.cpu_count() or 1, concurrency))}{resumed_text}")
+                        run_sharded_scan(cache_path, mode, concurrency, timeout, reporter.update, total, start_cursor, record_hit, save_cursor, should_stop, target_spec, probe_options, scan_stats)
+                    else:
+                        announce(total, resumed_text)
+                        asyncio.run(async_scanner_orchestrator(targets, concurrency, timeout, progress_callback, total, record_hit,
+                                                               start_index=start_cursor, cursor_callback=save_cursor, should_stop=should_stop, stats=scan_stats, **probe_options))
+                finally: reporter.close()
+        with open(hits_path, 'r', encoding='utf-8') as hits_file: live_results = sorted(set(line.strip() for line in hits_file if line.strip()))
+    except OSError as e:
+        release_stop_key(context, chat_id, stop_flag)
         try: msg.edit_text(f"❌ 读取缓存文件失败: {e}")
         except (BadRequest, RetryAfter, TimedOut): pass
         return
 
-    scan_type_text = "TCP存活扫描" if mode == 'tcping' else "子网扫描"
-    
-    async def main_scan_logic():
-        last_update_time = 0
-        
-        async def progress_callback(completed, total):
-            nonlocal last_update_time
-            current_time = time.time()
-            if total > 0 and current_time - last_update_time > 2:
-                percentage = (completed / total) * 100
-                progress_bar = create_progress_bar(percentage)
-                try:
-                    await msg.edit_text(
-                        f"2/3: 正在进行异步{scan_type_text}...\n"
-                        f"{progress_bar} ({completed}/{total})"
-                    )
-                    last_update_time = current_time
-                except (BadRequest, RetryAfter, TimedOut):
-                    pass # Ignore if editing fails, continue scanning
-
-        initial_message = f"2/3: 已加载 {len(targets)} 个目标，开始异步{scan_type_text} (并发: {concurrency}, 超时: {timeout}s)..."
-        try:
-            await msg.edit_text(initial_message)
-        except (BadRequest, RetryAfter, TimedOut):
-            pass
-
-        return await async_scanner_orchestrator(targets, concurrency, timeout, mode, progress_callback)
-
-    live_results = asyncio.run(main_scan_logic())
-    
+    stopped = release_stop_key(context, chat_id, stop_flag)
+    if not stopped: clear_scan_state(original_query, mode)
+    cache_text = f"\n♻️ 存活缓存命中 {scan_stats['cache_hits']} 个目标, 省去了这些探测。" if scan_stats.get('cache_hits') else ""
+    cache_text = scan_stats.get('plan_text', "") + cache_text
+    if scan_stats.get('resolved_names'): cache_text += f"\n🌐 共解析 {scan_stats['resolved_names']} 个域名 (每个仅解析一次)。"
+    if scan_stats.get('early_stopped'): cache_text += f"\n⏭️ 主机命中达到上限后跳过了 {scan_stats['early_stopped']} 次探测。"
     if not live_results:
-        try: msg.edit_text("🤷‍♀️ 扫描完成，但未发现任何存活的目标。")
+        try: msg.edit_text(("🌀 扫描已手动停止，可在扫描选项中勾选“从断点继续”。" if stopped else "🤷‍♀️ 扫描完成，但未发现任何存活的目标。") + cache_text)
         except (BadRequest, RetryAfter, TimedOut): pass
         return
 
@@ -540,9 +1331,18 @@ def run_async_scan_job(context: CallbackContext):
     except (BadRequest, RetryAfter, TimedOut): pass
     
     output_filename = generate_filename_from_query(original_query, prefix=f"{mode}_scan")
-    with open(output_filename, 'w', encoding='utf-8') as f: f.write("\n".join(sorted(list(live_results))))
+    if mode == 'sweep':
+        # 多端口扫描输出 主机 -> 开放端口 的映射，每台主机一行: host 22,80,443
+        ports_by_host = group_sweep_hits(live_results)
+        with open(output_filename, 'w', encoding='utf-8') as f: f.write("\n".join(f"{host} {','.join(map(str, ports))}" for host, ports in ports_by_host.items()))
+        found_text = f"*{len(ports_by_host)}* 台主机的 *{len(live_results)}* 个开放端口"
+    else:
+        with open(output_filename, 'w', encoding='utf-8') as f: f.write("\n".join(live_results))
+        found_text = f"*{len(live_results)}* 个存活目标"
     
-    final_caption = f"✅ *异步{escape_markdown_v2(scan_type_text)}完成\!*\n\n共发现 *{len(live_results)}* 个存活目标\\."
+    if stopped: final_caption = f"🌀 *异步{escape_markdown_v2(scan_type_text)}已手动停止*\n\n目前已发现 {found_text}, 可在扫描选项中勾选“从断点继续”\\."
+    else: final_caption = f"✅ *异步{escape_markdown_v2(scan_type_text)}完成\!*\n\n共发现 {found_text}\\."
+    final_caption += escape_markdown_v2(cache_text)
     send_file_safely(context, chat_id, output_filename, caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2)
     upload_and_send_links(context, chat_id, output_filename)
     os.remove(output_filename)
@@ -559,8 +1359,8 @@ def offer_post_download_actions(context: CallbackContext, chat_id, query_text):
 
     keyboard = [[
         InlineKeyboardButton("⚡️ 异步TCP存活扫描", callback_data=f'start_scan_tcping_{query_hash}'),
-        InlineKeyboardButton("🌐 异步子网扫描(/24)", callback_data=f'start_scan_subnet_{query_hash}')
-    ]]
+        InlineKeyboardButton("🌐 异步子网扫描", callback_data=f'start_scan_subnet_{query_hash}')
+    ], [InlineKeyboardButton("🎯 多端口扫描 (Top端口)", callback_data=f'start_scan_sweep_{query_hash}')]]
     context.bot.send_message(chat_id, "下载完成，需要对结果进行二次扫描吗？", reply_markup=InlineKeyboardMarkup(keyboard))
 def start_scan_callback(update: Update, context: CallbackContext) -> int:
     query = update.callback_query; query.answer()
@@ -595,21 +1395,676 @@ def get_timeout_callback(update: Update, context: CallbackContext) -> int:
     try:
         timeout = float(update.message.text)
         if not 0.1 <= timeout <= 10: raise ValueError
-        msg = update.message.reply_text("✅ 参数设置完毕，任务已提交到后台。")
-        job_context = {
-            'chat_id': update.effective_chat.id, 'msg': msg,
-            'original_query': context.user_data['scan_original_query'],
-            'mode': context.user_data['scan_mode'],
-            'concurrency': context.user_data['scan_concurrency'],
-            'timeout': timeout
-        }
-        context.job_queue.run_once(run_async_scan_job, 1, context=job_context, name=f"scan_{update.effective_chat.id}")
-        context.user_data.clear()
-        return ConversationHandler.END
+        context.user_data['scan_timeout'] = timeout
+        # 只有存在断点时才提供“从断点继续”，并默认勾选
+        checkpoint = load_scan_checkpoint(context.user_data['scan_original_query'], context.user_data['scan_mode'])
+        mode = context.user_data['scan_mode']
+        context.user_data['scan_options'] = {key: key == 'resume' for key, _ in SCAN_OPTION_DEFS if (key != 'resume' or checkpoint) and (mode == 'subnet' or key not in SUBNET_ONLY_SCAN_OPTIONS)}
+        spec = checkpoint.get('spec', {}) if checkpoint else {}
+        if spec.get('interleave'): context.user_data['scan_options']['interleave'] = True
+        if spec.get('plan_path'): context.user_data['scan_options'].update(smart_subnet=True, probe_rest=spec.get('probe_rest', False))
+        if context.user_data['scan_mode'] == 'subnet': context.user_data['scan_options']['prefix'] = spec.get('prefix', 24)
+        if mode == 'sweep': context.user_data['scan_options'].update(top_ports=spec.get('top_ports', SWEEP_PORT_CHOICES[0]), hit_limit=0)
+        update.message.reply_text("可选的扫描选项 (点击切换)：", reply_markup=build_scan_options_keyboard(context.user_data['scan_options']))
+        return SCAN_STATE_OPTIONS
     except ValueError:
         update.message.reply_text("无效输入，请输入 0.1-10 之间的数字。")
         return SCAN_STATE_GET_TIMEOUT
 
+SCAN_PER_SUBNET_LIMIT = 32
+# 扫描选项开关: (键, 按钮文字)
+SCAN_OPTION_DEFS = [
+    ('multiprocess', f"多进程分片 ({os.cpu_count() or 1}核)"),
+    ('raw_probe', "轻量探测引擎 (sock_connect)"),
+    ('adaptive_timeout', "按C段RTT自适应超时"),
+    ('interleave', "交错目标顺序 (分散到不同网段)"),
+    ('subnet_cap', f"单C段并发上限 {SCAN_PER_SUBNET_LIMIT}"),
+    ('liveness_cache', f"复用{LivenessCache.TTL_SECONDS // 3600}小时内的探测结果"),
+    ('smart_subnet', "FOFA辅助: 优先探测网段内已知资产"),
+    ('probe_rest', "FOFA辅助后继续探测网段其余地址"),
+    ('resume', "从断点继续"),
+]
+SUBNET_ONLY_SCAN_OPTIONS = {'smart_subnet', 'probe_rest'}
+
+def build_scan_options_keyboard(options):
+    keyboard = [[InlineKeyboardButton(f"{'✅' if options.get(key) else '⬜️'} {label}", callback_data=f'scanopt_toggle_{key}')] for key, label in SCAN_OPTION_DEFS if key in options]
+    if 'prefix' in options: keyboard.append([InlineKeyboardButton(f"🔁 网段前缀: /{options['prefix']} (点击切换)", callback_data='scanopt_prefix')])
+    if 'top_ports' in options:
+        keyboard.append([InlineKeyboardButton(f"🔁 端口: Top {options['top_ports']}", callback_data='scanopt_topports'),
+                         InlineKeyboardButton(f"🔁 单主机命中上限: {options['hit_limit'] or '不限'}", callback_data='scanopt_hitlimit')])
+    keyboard.append([InlineKeyboardButton("🚀 开始扫描", callback_data='scanopt_start'), InlineKeyboardButton("❌ 取消", callback_data='scanopt_cancel')])
+    return InlineKeyboardMarkup(keyboard)
+
+def scan_options_callback(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query; query.answer()
+    action = query.data[len('scanopt_'):]
+    if action == 'cancel':
+        query.message.edit_text("操作已取消。"); context.user_data.clear()
+        return ConversationHandler.END
+    if action.startswith('toggle_'):
+        options = context.user_data['scan_options']; key = action[len('toggle_'):]
+        options[key] = not options.get(key)
+        try: query.message.edit_reply_markup(reply_markup=build_scan_options_keyboard(options))
+        except BadRequest: pass
+        return SCAN_STATE_OPTIONS
+    cycles = {'prefix': ('prefix', SUBNET_PREFIX_CHOICES), 'topports': ('top_ports', SWEEP_PORT_CHOICES), 'hitlimit': ('hit_limit', SWEEP_HIT_LIMIT_CHOICES)}
+    if action in cycles:
+        options = context.user_data['scan_options']; key, choices = cycles[action]
+        options[key] = choices[(choices.index(options[key]) + 1) % len(choices)]
+        try: query.message.edit_reply_markup(reply_markup=build_scan_options_keyboard(options))
+        except BadRequest: pass
+        return SCAN_STATE_OPTIONS
+    query.message.edit_text("✅ 参数设置完毕，任务已提交到后台。")
+    job_context = {
+        'chat_id': update.effective_chat.id, 'msg': query.message,
+        'original_query': context.user_data['scan_original_query'],
+        'mode': context.user_data['scan_mode'],
+        'concurrency': context.user_data['scan_concurrency'],
+        'timeout': context.user_data['scan_timeout'],
+        'options': dict(context.user_data['scan_options'])
+    }
+    context.job_queue.run_once(run_async_scan_job, 1, context=job_context, name=f"scan_{update.effective_chat.id}")
+    context.user_data.clear()
+    return ConversationHandler.END
+
+# --- 缓存行偏移索引 ---
+# 每个缓存文件旁边有一个 <文件>.idx，按顺序存放每行起始位置的 uint64 偏移。
+# 通过 mmap 读取即可 O(1) 得到行数和任意一行，无需把整个文件读入内存。
+LINE_INDEX_EXT = '.idx'
+VIEW_PAGE_SIZE = 50
+MAX_VIEW_QUERIES = 20 # 每个会话保留翻页状态的查询数
+
+def write_cache_lines(path, lines):
+    """写出缓存文件并同时生成行偏移索引，返回行数。lines 可以是生成器，偏移分块落盘，内存占用恒定。"""
+    offsets, position, count = array('Q'), 0, 0
+    with open(path, 'wb') as f, open(path + LINE_INDEX_EXT, 'wb') as index_file:
+        for line in lines:
+            encoded = (line + "\n").encode('utf-8')
+            offsets.append(position); f.write(encoded); position += len(encoded)
+            if len(offsets) >= 65536: offsets.tofile(index_file); count += len(offsets); offsets = array('Q')
+        offsets.tofile(index_file); count += len(offsets)
+    return count
+
+def build_line_index(path):
+    """为已有文件(如导入的缓存)补建行偏移索引，返回行数。"""
+    offsets, position, count = array('Q'), 0, 0
+    with open(path, 'rb') as f, open(path + LINE_INDEX_EXT, 'wb') as index_file:
+        for line in f:
+            offsets.append(position); position += len(line)
+            if len(offsets) >= 65536: offsets.tofile(index_file); count += len(offsets); offsets = array('Q')
+        offsets.tofile(index_file); count += len(offsets)
+    return count
+
+def _ensure_line_index(path):
+    index_path = path + LINE_INDEX_EXT
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(path):
+        build_line_index(path)
+    return index_path
+
+def count_cache_lines(path):
+    return os.path.getsize(_ensure_line_index(path)) // array('Q').itemsize
+
+class CachedLineIndex:
+    """只读地随机访问缓存文件的任意行。"""
+    def __init__(self, path):
+        index_path = _ensure_line_index(path)
+        self._data_file, self._index_file = open(path, 'rb'), open(index_path, 'rb')
+        self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b''
+        index_size = os.path.getsize(index_path)
+        self._offsets = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ) if index_size else b''
+        self._item_size = array('Q').itemsize
+        self._count = index_size // self._item_size
+
+    def __len__(self): return self._count
+
+    def _offset(self, i):
+        if i >= self._count: return len(self._data)
+        return array('Q', self._offsets[i * self._item_size:(i + 1) * self._item_size])[0]
+
+    def line(self, i):
+        if not 0 <= i < self._count: raise IndexError(i)
+        return self._data[self._offset(i):self._offset(i + 1)].decode('utf-8', errors='replace').rstrip('\r\n')
+
+    def lines(self, start, stop):
+        return [self.line(i) for i in range(max(0, start), min(stop, self._count))]
+
+    def contains(self, text):
+        """二分查找某一行是否存在，要求文件已排序 (见 ensure_sorted_cache)。文件无序时可能漏判，但不会误判为存在。"""
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self.line(mid) < text: low = mid + 1
+            else: high = mid
+        return low < self._count and self.line(low) == text
+
+    def close(self):
+        for obj in (self._data, self._offsets):
+            if isinstance(obj, mmap.mmap): obj.close()
+        self._data_file.close(); self._index_file.close()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+def resolve_cached_query_arg(text):
+    """`#N` 表示 /history 中的第N条，否则按查询语句原文匹配；返回历史记录项或 None。"""
+    text = text.strip()
+    match = re.match(r'^#(\d+)$', text)
+    if match:
+        index = int(match.group(1)) - 1
+        if 0 <= index < len(HISTORY['queries']): text = HISTORY['queries'][index]['query_text']
+        else: return None
+    return find_cached_query(text)
+
+def build_view_page(query_text, file_path, page):
+    """返回 (消息文本, 键盘)，页码会被夹到有效范围内。"""
+    with CachedLineIndex(file_path) as index:
+        total = len(index)
+        total_pages = max(1, (total + VIEW_PAGE_SIZE - 1) // VIEW_PAGE_SIZE)
+        page = min(max(1, page), total_pages)
+        start = (page - 1) * VIEW_PAGE_SIZE
+        rows = index.lines(start, start + VIEW_PAGE_SIZE)
+    body = escape_markdown_v2_code("\n".join(f"{start + i + 1}. {row[:70]}" for i, row in enumerate(rows)))
+    text = (f"👁 *缓存预览* `{escape_markdown_v2(query_text)}`\n"
+            f"第 {page}/{total_pages} 页, 共 {total} 条\n```\n{body}\n```")
+    query_hash = hashlib.md5(query_text.encode()).hexdigest()
+    nav_row = []
+    if page > 1: nav_row.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"view_{query_hash}_{page - 1}"))
+    if page < total_pages: nav_row.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"view_{query_hash}_{page + 1}"))
+    return text, InlineKeyboardMarkup([nav_row]) if nav_row else None
+
+@admin_only
+def view_command(update: Update, context: CallbackContext):
+    if not context.args:
+        update.message.reply_text("用法: `/view <query|#历史编号> [页码]`\n\n示例:\n`/view #1 3`", parse_mode=ParseMode.MARKDOWN_V2)
+        return
+    args, page = list(context.args), 1
+    if len(args) > 1 and args[-1].isdigit(): page = int(args.pop())
+    cached_item = resolve_cached_query_arg(" ".join(args))
+    if not cached_item: update.message.reply_text("❌ 找不到该查询的本地缓存。可使用 /history 查看编号。"); return
+    query_text = cached_item['query_text']
+    # 翻页按钮只携带查询的哈希，对应的查询保存在本会话的 chat_data 中，与扫描任务互不干扰
+    view_queries = context.chat_data.setdefault('view_queries', {})
+    query_hash = hashlib.md5(query_text.encode()).hexdigest(); view_queries.pop(query_hash, None); view_queries[query_hash] = query_text
+    while len(view_queries) > MAX_VIEW_QUERIES: view_queries.pop(next(iter(view_queries)))
+    text, keyboard = build_view_page(query_text, cached_item['cache']['file_path'], page)
+    update.message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
+
+@admin_only
+def view_page_callback(update: Update, context: CallbackContext):
+    query = update.callback_query; query.answer()
+    try: _, query_hash, page_str = query.data.split('_', 2); page = int(page_str)
+    except ValueError: return
+    query_text = context.chat_data.get('view_queries', {}).get(query_hash)
+    cached_item = find_cached_query(query_text) if query_text else None
+    if not cached_item: query.message.edit_text("❌ 缓存已失效或已被删除。"); return
+    text, keyboard = build_view_page(query_text, cached_item['cache']['file_path'], page)
+    try: query.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
+    except BadRequest: pass
+
+# --- 缓存结果集的集合运算 (/diff /union /intersect) ---
+# 两个输入都保证为已排序文件后做流式归并，内存占用与文件大小无关。
+SET_OPERATIONS = {'diff': '−', 'union': '∪', 'intersect': '∩'}
+EXTERNAL_SORT_CHUNK_LINES = 200000
+
+def _iter_sorted_unique(path):
+    """逐行读取已排序的缓存文件，跳过空行和相邻的重复行。"""
+    previous = None
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and line != previous: yield line; previous = line
+
+def _is_sorted_cache(path):
+    previous = None
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            if previous is not None and line < previous: return False
+            previous = line
+    return True
+
+def ensure_sorted_cache(path):
+    """
+    保证缓存文件按行有序(导入的旧文件可能无序)。
+    无序时分块排序写出临时文件，再用 heapq.merge 归并回原文件并重建索引。返回是否改写了文件。
+    """
+    if _is_sorted_cache(path): return False
+    run_paths = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            while True:
+                chunk = [line.strip() for line in itertools.islice(f, EXTERNAL_SORT_CHUNK_LINES)]
+                if not chunk: break
+                run_path = f"{path}.run{len(run_paths)}"
+                with open(run_path, 'w', encoding='utf-8') as run_file: run_file.writelines(line + "\n" for line in sorted(filter(None, chunk)))
+                run_paths.append(run_path)
+        run_files = [open(p, 'r', encoding='utf-8') for p in run_paths]
+        try:
+            merged = (line.rstrip("\n") for line in heapq.merge(*run_files))
+            deduped = (line for line, _ in itertools.groupby(merged))
+            write_cache_lines(path + ".sorted", deduped)
+        finally:
+            for run_file in run_files: run_file.close()
+        os.replace(path + ".sorted", path); os.replace(path + ".sorted" + LINE_INDEX_EXT, path + LINE_INDEX_EXT)
+    finally:
+        for run_path in run_paths:
+            if os.path.exists(run_path): os.remove(run_path)
+    return True
+
+def merge_sorted_lines(iter_a, iter_b, op):
+    """对两个已排序且去重的行流做集合运算: diff (A-B) / union / intersect。"""
+    a, b = next(iter_a, None), next(iter_b, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a < b):
+            if op != 'intersect': yield a
+            a = next(iter_a, None)
+        elif a is None or b < a:
+            if op == 'union': yield b
+            b = next(iter_b, None)
+        else:
+            if op != 'diff': yield a
+            a, b = next(iter_a, None), next(iter_b, None)
+
+@admin_only
+def set_operation_command(update: Update, context: CallbackContext):
+    op = update.message.text.split()[0].lstrip('/').split('@')[0].lower()
+    if len(context.args) != 2:
+        update.message.reply_text(f"用法: `/{op} #编号A #编号B`\n\n编号来自 /history，例如 `/{op} #1 #2`", parse_mode=ParseMode.MARKDOWN_V2)
+        return
+    items = [resolve_cached_query_arg(arg) for arg in context.args]
+    if not all(items):
+        update.message.reply_text("❌ 找不到对应编号的本地缓存，请使用 /history 确认编号。"); return
+    msg = update.message.reply_text("⏳ 正在准备集合运算...")
+    job_context = {'chat_id': update.effective_chat.id, 'msg': msg, 'op': op, 'queries': [item['query_text'] for item in items]}
+    context.job_queue.run_once(run_set_operation_job, 1, context=job_context, name=f"setop_{update.effective_chat.id}")
+
+def run_set_operation_job(context: CallbackContext):
+    job_data = context.job.context; chat_id, msg, op, (query_a, query_b) = job_data['chat_id'], job_data['msg'], job_data['op'], job_data['queries']
+    items = [find_cached_query(query_a), find_cached_query(query_b)]
+    if not all(items):
+        try: msg.edit_text("❌ 缓存已失效或已被删除。")
+        except (BadRequest, RetryAfter, TimedOut): pass
+        return
+    paths = [item['cache']['file_path'] for item in items]
+    result_name = f"({query_a}) {SET_OPERATIONS[op]} ({query_b})"
+    output_filename = generate_filename_from_query(f"{query_a}_{query_b}", prefix=op)
+    cache_path = os.path.join(FOFA_CACHE_DIR, output_filename)
+    try:
+        try: msg.edit_text("1/2: 正在检查输入文件顺序...")
+        except (BadRequest, RetryAfter, TimedOut): pass
+        for item, path in zip(items, paths):
+            if ensure_sorted_cache(path): schedule_host_indexing(item['query_text'], path, 'txt')
+        try: msg.edit_text("2/2: 正在流式归并...")
+        except (BadRequest, RetryAfter, TimedOut): pass
+        result_count = write_cache_lines(cache_path, merge_sorted_lines(_iter_sorted_unique(paths[0]), _iter_sorted_unique(paths[1]), op))
+    except OSError as e:
+        # 缓存文件在排队期间被删除或磁盘已满: 清理不完整的输出，避免状态停在归并阶段
+        logger.error(f"集合运算失败: {e}")
+        for path in (cache_path, cache_path + LINE_INDEX_EXT):
+            if os.path.exists(path): os.remove(path)
+        try: msg.edit_text(f"❌ 集合运算失败: {e}")
+        except (BadRequest, RetryAfter, TimedOut): pass
+        return
+    if result_count == 0:
+        os.remove(cache_path); os.remove(cache_path + LINE_INDEX_EXT)
+        try: msg.edit_text("🤷‍♀️ 运算完成，结果为空。")
+        except (BadRequest, RetryAfter, TimedOut): pass
+        return
+    try: msg.edit_text(f"✅ 运算完成！共 {result_count} 条。正在发送...")
+    except (BadRequest, RetryAfter, TimedOut): pass
+    send_file_safely(context, chat_id, cache_path, caption=f"{op}: {result_name}"[:1000], filename=output_filename)
+    upload_and_send_links(context, chat_id, cache_path)
+    add_or_update_query(result_name, {'file_path': cache_path, 'result_count': result_count})
+    offer_post_download_actions(context, chat_id, result_name)
+
+# --- 列式存储 (/batch 结果缓存) ---
+# 每个字段单独存为一个 .col 文件，每行一个JSON编码的值，行号即记录号。
+# 重新导出时只打开所需字段的列文件，逐行流式读取，无需再次请求FOFA。
+class ColumnarStoreWriter:
+    def __init__(self, query_text, fields):
+        self.query_text = query_text
+        self.fields = list(fields)
+        self.row_count = 0
+        store_name = f"{hashlib.md5(query_text.encode()).hexdigest()}_{int(time.time())}"
+        self.store_dir = os.path.join(COLUMNAR_DIR, store_name)
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._handles = [open(os.path.join(self.store_dir, f"{i}.col"), 'w', encoding='utf-8') for i in range(len(self.fields))]
+
+    def append_rows(self, rows):
+        width = len(self.fields)
+        normalized = []
+        for row in rows:
+            # 只请求一个字段时FOFA返回的是字符串而不是列表
+            if not isinstance(row, list): row = [row]
+            if len(row) < width: row = row + [""] * (width - len(row))
+            normalized.append(row)
+        if not normalized: return
+        for i, handle in enumerate(self._handles):
+            handle.write("".join(json.dumps(r[i], ensure_ascii=False) + "\n" for r in normalized))
+        self.row_count += len(normalized)
+
+    def _close_handles(self):
+        for handle in self._handles:
+            try: handle.close()
+            except OSError: pass
+        self._handles = []
+
+    def commit(self, complete=True):
+        """关闭列文件并登记到 BATCH_STORES，返回存储的元数据；没有数据时返回 None。"""
+        self._close_handles()
+        if self.row_count == 0:
+            shutil.rmtree(self.store_dir, ignore_errors=True)
+            return None
+        meta = {
+            'query': self.query_text, 'dir': self.store_dir, 'fields': self.fields, 'rows': self.row_count,
+            'complete': complete, 'timestamp': datetime.now(tz.tzutc()).isoformat(),
+        }
+        with open(os.path.join(self.store_dir, 'meta.json'), 'w', encoding='utf-8') as f: json.dump(meta, f, ensure_ascii=False)
+        store_key = hashlib.md5(self.query_text.encode()).hexdigest()
+        old_meta = BATCH_STORES.pop(store_key, None)
+        if old_meta and old_meta.get('dir') != self.store_dir:
+            shutil.rmtree(old_meta['dir'], ignore_errors=True); remove_host_index_source(old_meta['dir'])
+        BATCH_STORES[store_key] = meta
+        while len(BATCH_STORES) > MAX_BATCH_STORES:
+            evicted = BATCH_STORES.pop(next(iter(BATCH_STORES)))
+            shutil.rmtree(evicted.get('dir', ''), ignore_errors=True); remove_host_index_source(evicted.get('dir', ''))
+        save_batch_stores()
+        schedule_host_indexing(self.query_text, self.store_dir, 'columnar')
+        return meta
+
+    def abort(self):
+        self._close_handles()
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+
+def find_columnar_store(query_text, fields=None):
+    meta = BATCH_STORES.get(hashlib.md5(query_text.encode()).hexdigest())
+    if not meta or not os.path.isdir(meta.get('dir', '')): return None
+    if fields and not set(fields).issubset(meta['fields']): return None
+    return meta
+
+def iter_columnar_rows(meta, fields=None):
+    """按给定字段顺序逐行产出记录，只读取被投影的列文件。"""
+    fields = list(fields) if fields else meta['fields']
+    handles = [open(os.path.join(meta['dir'], f"{meta['fields'].index(f)}.col"), 'r', encoding='utf-8') for f in fields]
+    try:
+        for lines in zip(*handles):
+            yield [json.loads(line) for line in lines]
+    finally:
+        for handle in handles: handle.close()
+
+# --- 流式表格写出 ---
+# 行逐条写入目标文件而不在内存中累积: xlsx 使用 openpyxl 的 write-only 模式(工作表边写边落盘)，csv/ndjson 逐行追加。
+EXPORT_FORMAT_EXTS = {'csv': '.csv', 'ndjson': '.ndjson', 'xlsx': '.xlsx'}
+XLSX_MAX_ROWS = 1048576 # Excel 单个工作表的行数上限，超出后续写到新工作表
+
+def _xlsx_cell(value):
+    if isinstance(value, (list, dict)): value = json.dumps(value, ensure_ascii=False)
+    # banner/header 中常见的控制字符是 xlsx 不允许的
+    return ILLEGAL_CHARACTERS_RE.sub('', value) if isinstance(value, str) else value
+
+class StreamingTableWriter:
+    def __init__(self, path, columns, fmt='csv'):
+        self.path, self.columns, self.fmt, self.row_count = path, list(columns), fmt, 0
+        if fmt == 'xlsx':
+            self._workbook = openpyxl.Workbook(write_only=True); self._new_sheet()
+        elif fmt == 'ndjson': self._file = open(path, 'w', encoding='utf-8')
+        else:
+            self._file = open(path, 'w', encoding='utf-8-sig', newline='')
+            self._csv = csv.writer(self._file); self._csv.writerow(self.columns)
+
+    def _new_sheet(self):
+        self._sheet = self._workbook.create_sheet(f"Sheet{len(self._workbook.worksheets) + 1}")
+        self._sheet.append(self.columns); self._sheet_rows = 1
+
+    def write_row(self, row):
+        if self.fmt == 'xlsx':
+            if self._sheet_rows >= XLSX_MAX_ROWS: self._new_sheet()
+            self._sheet.append([_xlsx_cell(value) for value in row]); self._sheet_rows += 1
+        elif self.fmt == 'ndjson': self._file.write(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + "\n")
+        else: self._csv.writerow(row)
+        self.row_count += 1
+
+    def write_rows(self, rows):
+        for row in rows: self.write_row(row)
+
+    def close(self):
+        if self.fmt == 'xlsx': self._workbook.save(self.path)
+        else: self._file.close()
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc_info): self.close()
+
+def export_columnar_store(meta, fields, fmt, output_path):
+    """将列存投影为 csv / ndjson / xlsx 文件，返回写出的行数。"""
+    fields = list(fields) if fields else meta['fields']
+    with StreamingTableWriter(output_path, fields, fmt) as writer: writer.write_rows(iter_columnar_rows(meta, fields))
+    return writer.row_count
+
+def _read_store_column(meta, field):
+    with open(os.path.join(meta['dir'], f"{meta['fields'].index(field)}.col"), 'r', encoding='utf-8') as f:
+        return pd.Series([json.loads(line) for line in f], name=field, dtype=object)
+
+def load_cached_frame(query_text, columns=None):
+    """
+    把某个查询的本地缓存加载为 DataFrame，返回 (df, 来源描述)；没有缓存时返回 (None, None)。
+    优先使用 /batch 列存 (只读取需要的列)，否则解析普通下载缓存中的 host 行。
+    """
+    meta = find_columnar_store(query_text)
+    if meta:
+        wanted = [c for c in (columns or meta['fields']) if c in meta['fields']]
+        if wanted:
+            return pd.concat([_read_store_column(meta, c) for c in wanted], axis=1), f"列存 ({meta['rows']} 条)"
+    cached_item = find_cached_query(query_text)
+    if not cached_item: return None, None
+    with open(cached_item['cache']['file_path'], 'r', encoding='utf-8') as f:
+        hosts = pd.Series([line.strip() for line in f if line.strip()], name='host', dtype=object)
+    parts = hosts.str.extract(r'^(?:(?P<protocol>[A-Za-z][\w+.-]*)://)?(?P<address>\[[0-9A-Fa-f:.]+\]|[^:/]+)(?::(?P<port>\d+))?')
+    is_ip = parts['address'].str.match(r'^(\d{1,3}(\.\d{1,3}){3}|\[[0-9A-Fa-f:.]+\])$').fillna(False)
+    df = pd.DataFrame({
+        'host': hosts,
+        'ip': parts['address'].str.strip('[]').where(is_ip, ''),
+        'domain': parts['address'].where(~is_ip, ''),
+        'port': parts['port'].fillna(''),
+        'protocol': parts['protocol'].fillna(''),
+    })
+    if columns: df = df[[c for c in columns if c in df.columns]]
+    return df, f"下载缓存 ({len(df)} 条)"
+
+def run_columnar_export_job(context: CallbackContext):
+    job_data = context.job.context; chat_id, query_text, fields, fmt = job_data['chat_id'], job_data['query'], job_data['fields'], job_data['fmt']
+    meta = find_columnar_store(query_text, fields)
+    if not meta: context.bot.send_message(chat_id, "❌ 本地列存已失效，请重新下载。"); return
+    output_filename = generate_filename_from_query(query_text, prefix="batch_local", ext=EXPORT_FORMAT_EXTS[fmt])
+    try:
+        count = export_columnar_store(meta, fields, fmt, output_filename)
+        send_file_safely(context, chat_id, output_filename, caption=f"✅ 本地导出完成 \\({count} 条\\)\n查询: `{escape_markdown_v2(query_text)}`", parse_mode=ParseMode.MARKDOWN_V2)
+        upload_and_send_links(context, chat_id, output_filename)
+    except Exception as e:
+        logger.error(f"Failed to export columnar store for '{query_text}': {e}")
+        context.bot.send_message(chat_id, f"❌ 本地导出失败: {e}")
+    finally:
+        if os.path.exists(output_filename): os.remove(output_filename)
+
+# --- 主机倒排索引 ---
+# 缓存落盘后，在后台把每一行登记为 (IPv4整数, 主机名, 端口) -> (来源缓存, 行号)。
+# /host 和 /batchfind 会先查这里，能用本地数据回答的就不再请求FOFA。
+HOST_INDEX_LOCK = threading.Lock()
+HOST_ENTRY_PATTERN = re.compile(r'^(?:[A-Za-z][\w+.-]*://)?(\[[0-9A-Fa-f:.]+\]|[^:/\s]+)(?::(\d+))?')
+
+def parse_host_entry(value):
+    """把 host/ip 字段拆成 (IPv4整数或None, 小写主机名, 端口或None)。"""
+    match = HOST_ENTRY_PATTERN.match(str(value).strip())
+    if not match: return None, None, None
+    host = match.group(1).strip('[]').lower()
+    port = int(match.group(2)) if match.group(2) else None
+    try: ip_int = int(ipaddress.IPv4Address(host))
+    except ValueError: ip_int = None
+    return ip_int, host, port
+
+def _host_index_connect():
+    conn = sqlite3.connect(HOST_INDEX_DB, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, query TEXT NOT NULL, path TEXT NOT NULL UNIQUE, kind TEXT NOT NULL, indexed_at TEXT);"
+        "CREATE TABLE IF NOT EXISTS postings (source_id INTEGER NOT NULL, row INTEGER NOT NULL, ip INTEGER, host TEXT, port INTEGER);"
+        "CREATE INDEX IF NOT EXISTS idx_postings_ip ON postings(ip);"
+        "CREATE INDEX IF NOT EXISTS idx_postings_host ON postings(host);"
+        "CREATE INDEX IF NOT EXISTS idx_postings_source ON postings(source_id);"
+    )
+    return conn
+
+def _iter_source_entries(path, kind):
+    """逐行产出 (行号, ip_int, host, port)。"""
+    if kind == 'columnar':
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f: meta = json.load(f)
+        columns = [c for c in ('ip', 'host', 'port') if c in meta['fields']]
+        if not columns: return
+        for row_num, row in enumerate(iter_columnar_rows(meta, columns)):
+            values = dict(zip(columns, row))
+            ip_int, host, port = parse_host_entry(values.get('host') or values.get('ip', ''))
+            if values.get('ip'):
+                column_ip, _, _ = parse_host_entry(values['ip'])
+                if column_ip is not None: ip_int = column_ip
+            if str(values.get('port', '')).isdigit(): port = int(values['port'])
+            if host: yield row_num, ip_int, host, port
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            for row_num, line in enumerate(f):
+                ip_int, host, port = parse_host_entry(line)
+                if host: yield row_num, ip_int, host, port
+
+def _delete_index_sources(conn, where, params):
+    for (source_id,) in conn.execute(f"SELECT id FROM sources WHERE {where}", params).fetchall():
+        conn.execute("DELETE FROM postings WHERE source_id = ?", (source_id,))
+        conn.execute("DELETE FROM sources WHERE id = ?", (source_id,))
+
+def index_host_source(query_text, path, kind):
+    """(重新)索引一个缓存来源；同一查询同类缓存的旧来源会被替换。"""
+    with HOST_INDEX_LOCK:
+        conn = _host_index_connect()
+        try:
+            with conn:
+                _delete_index_sources(conn, "path = ? OR (query = ? AND kind = ?)", (path, query_text, kind))
+                source_id = conn.execute(
+                    "INSERT INTO sources (query, path, kind, indexed_at) VALUES (?, ?, ?, ?)",
+                    (query_text, path, kind, datetime.now(tz.tzutc()).isoformat())
+                ).lastrowid
+                batch, total = [], 0
+                for row_num, ip_int, host, port in _iter_source_entries(path, kind):
+                    batch.append((source_id, row_num, ip_int, host, port))
+                    if len(batch) >= 50000:
+                        conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?, ?)", batch); total += len(batch); batch = []
+                if batch: conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?, ?)", batch); total += len(batch)
+        finally:
+            conn.close()
+    logger.info(f"主机索引已更新: '{query_text}' ({kind}) 共 {total} 条")
+
+def remove_host_index_source(path):
+    with HOST_INDEX_LOCK:
+        conn = _host_index_connect()
+        try:
+            with conn: _delete_index_sources(conn, "path = ?", (path,))
+        finally:
+            conn.close()
+
+def schedule_host_indexing(query_text, path, kind):
+    def worker():
+        try: index_host_source(query_text, path, kind)
+        except Exception as e: logger.error(f"索引缓存 '{path}' 失败: {e}")
+    threading.Thread(target=worker, daemon=True).start()
+
+def backfill_host_index():
+    """启动时补建索引: 为历史记录和列存中尚未登记的缓存建立索引。"""
+    conn = _host_index_connect()
+    try: indexed_paths = {row[0] for row in conn.execute("SELECT path FROM sources")}
+    finally: conn.close()
+    pending = [(q['query_text'], q['cache']['file_path'], 'txt') for q in HISTORY['queries'] if q.get('cache') and q['cache'].get('file_path')]
+    pending += [(meta['query'], meta['dir'], 'columnar') for meta in BATCH_STORES.values()]
+    for query_text, path, kind in pending:
+        if path in indexed_paths or not os.path.exists(path): continue
+        try: index_host_source(query_text, path, kind)
+        except Exception as e: logger.error(f"补建索引 '{path}' 失败: {e}")
+
+def lookup_host_index_many(targets):
+    """批量查询倒排索引，返回 {target: [{'query', 'path', 'kind', 'row', 'port'}, ...]}。"""
+    found = {}
+    if not targets or not os.path.exists(HOST_INDEX_DB): return found
+    conn = _host_index_connect()
+    try:
+        for target in targets:
+            ip_int, host, port = parse_host_entry(target)
+            if not host: continue
+            sql = "SELECT s.query, s.path, s.kind, p.row, p.port FROM postings p JOIN sources s ON s.id = p.source_id WHERE "
+            params = [ip_int] if ip_int is not None else [host]
+            sql += "p.ip = ?" if ip_int is not None else "p.host = ?"
+            if port is not None: sql += " AND p.port = ?"; params.append(port)
+            hits = [{'query': q, 'path': p, 'kind': k, 'row': r, 'port': pt} for q, p, k, r, pt in conn.execute(sql, params) if os.path.exists(p)]
+            if hits: found[target] = hits
+    finally:
+        conn.close()
+    return found
+
+def lookup_host_index(target):
+    return lookup_host_index_many([target]).get(target, [])
+
+def summarize_index_hits(hits):
+    """按来源查询汇总命中行数，命中多的排在前面。"""
+    counts = {}
+    for hit in hits: counts[hit['query']] = counts.get(hit['query'], 0) + 1
+    return sorted(counts.items(), key=lambda item: -item[1])
+
+def fetch_indexed_store_rows(hits_by_target, fields):
+    """
+    从命中的列存中取出记录: 返回 {target: (来源查询, [按 fields 排列的值])}。
+    只使用包含全部 fields 的列存，每个列存只顺序扫描一遍。
+    """
+    wanted = {}
+    for target, hits in hits_by_target.items():
+        for hit in hits:
+            if hit['kind'] != 'columnar': continue
+            meta = find_columnar_store(hit['query'], fields)
+            if not meta or meta['dir'] != hit['path']: continue
+            wanted.setdefault(hit['path'], (meta, {}))[1].setdefault(hit['row'], []).append(target)
+            break
+    resolved = {}
+    for meta, rows_to_targets in wanted.values():
+        remaining = len(rows_to_targets)
+        for row_num, row in enumerate(iter_columnar_rows(meta, fields)):
+            for target in rows_to_targets.get(row_num, []): resolved.setdefault(target, (meta['query'], row))
+            if row_num in rows_to_targets:
+                remaining -= 1
+                if remaining == 0: break
+    return resolved
+
+def load_indexed_host_rows_many(hits_by_target):
+    """
+    为 /host 取出每个目标命中最多的那个列存中的所有相关记录，返回 {target: (fields, rows)}。
+    多个目标命中同一列存时合并处理，每个列存只顺序扫描一遍。
+    """
+    wanted = {}
+    for target, hits in hits_by_target.items():
+        for query_text, _ in summarize_index_hits([h for h in hits if h['kind'] == 'columnar']):
+            meta = find_columnar_store(query_text, ['ip', 'port'])
+            if meta:
+                rows_to_targets = wanted.setdefault(meta['dir'], (meta, {}))[1]
+                for row_num in {h['row'] for h in hits if h['path'] == meta['dir']}: rows_to_targets.setdefault(row_num, []).append(target)
+                break
+    loaded = {}
+    for meta, rows_to_targets in wanted.values():
+        remaining = len(rows_to_targets)
+        for row_num, row in enumerate(iter_columnar_rows(meta)):
+            if row_num not in rows_to_targets: continue
+            for target in rows_to_targets[row_num]: loaded.setdefault(target, (meta['fields'], []))[1].append(row)
+            remaining -= 1
+            if remaining == 0: break
+    return loaded
+
+def load_indexed_host_rows(hits):
+    """单个目标的 load_indexed_host_rows_many，返回 (fields, rows)。"""
+    return load_indexed_host_rows_many({None: hits}).get(None, (None, []))
+
 # --- 后台下载任务 ---
 def start_download_job(context: CallbackContext, callback_func, job_data):
     chat_id = job_data['chat_id']; job_name = f"download_job_{chat_id}"
@@ -620,6 +2075,7 @@ def run_full_download_query(context: CallbackContext):
     job_data = context.job.context; bot, chat_id, query_text, total_size = context.bot, job_data['chat_id'], job_data['query'], job_data['total_size']
     output_filename = generate_filename_from_query(query_text); unique_results, stop_flag = set(), f'stop_job_{chat_id}'
     msg = bot.send_message(chat_id, "⏳ 开始全量下载任务..."); pages_to_fetch = (total_size + 9999) // 10000
+    pipeline = start_download_pipeline(context, job_data, query_text)
     for page in range(1, pages_to_fetch + 1):
         if context.bot_data.get(stop_flag): msg.edit_text("🌀 下载任务已手动停止."); break
         try: msg.edit_text(f"下载进度: {len(unique_results)}/{total_size} (Page {page}/{pages_to_fetch})...")
@@ -635,11 +2091,12 @@ def run_full_download_query(context: CallbackContext):
         results = data.get('results', []);
         if not results: break
         unique_results.update(res for res in results if ':' in res)
+        if pipeline: pipeline.feed(res for res in results if ':' in res)
+    if pipeline: pipeline.finish(stopped=bool(context.bot_data.get(stop_flag)))
     if unique_results:
-        with open(output_filename, 'w', encoding='utf-8') as f: f.write("\n".join(unique_results))
-        msg.edit_text(f"✅ 下载完成！共 {len(unique_results)} 条。正在发送...")
         cache_path = os.path.join(FOFA_CACHE_DIR, output_filename)
-        shutil.move(output_filename, cache_path)
+        write_cache_lines(cache_path, sorted(unique_results))
+        msg.edit_text(f"✅ 下载完成！共 {len(unique_results)} 条。正在发送...")
         send_file_safely(context, chat_id, cache_path, filename=output_filename)
         upload_and_send_links(context, chat_id, cache_path)
         cache_data = {'file_path': cache_path, 'result_count': len(unique_results)}
@@ -650,6 +2107,7 @@ def run_traceback_download_query(context: CallbackContext):
     job_data = context.job.context; bot, chat_id, base_query = context.bot, job_data['chat_id'], job_data['query']; limit = job_data.get('limit')
     output_filename = generate_filename_from_query(base_query); unique_results, page_count, last_page_date, termination_reason, stop_flag, last_update_time = set(), 0, None, "", f'stop_job_{chat_id}', 0
     msg = bot.send_message(chat_id, "⏳ 开始深度追溯下载...")
+    pipeline = start_download_pipeline(context, job_data, base_query)
     current_query = base_query
     guest_key = job_data.get('guest_key')
     
@@ -667,13 +2125,13 @@ def run_traceback_download_query(context: CallbackContext):
         else:
             def query_logic(key, key_level, proxy_session):
                 nonlocal fields_were_extended
-                # Personal members and above can search this field.
-                if key_level >= 1:
-                    fields_were_extended = True
-                    return fetch_fofa_data(key, current_query, 1, 10000, fields="host,lastupdatetime", proxy_session=proxy_session)
-                else:
-                    fields_were_extended = False
-                    return fetch_fofa_data(key, current_query, 1, 10000, fields="host", proxy_session=proxy_session)
+                # Personal members and above can search this field; 以Key能力缓存为准，被拒绝时记住并退回
+                fields_were_extended = key_capability(key)['lastupdatetime']
+                if fields_were_extended:
+                    data, error = fetch_fofa_data(key, current_query, 1, 10000, fields="host,lastupdatetime", proxy_session=proxy_session)
+                    if not (error and KEY_FIELD_DENIED_ERROR in str(error)): return data, error
+                    learn_key_capability(key, lastupdatetime=False); fields_were_extended = False
+                return fetch_fofa_data(key, current_query, 1, 10000, fields="host", proxy_session=proxy_session)
             
             # 仅在第一次迭代时选择并锁定代理
             if locked_proxy_session is None:
@@ -693,6 +2151,7 @@ def run_traceback_download_query(context: CallbackContext):
         original_count = len(unique_results)
         unique_results.update(newly_added)
         newly_added_count = len(unique_results) - original_count
+        if pipeline: pipeline.feed(newly_added)
 
         if limit and len(unique_results) >= limit: unique_results = set(list(unique_results)[:limit]); termination_reason = f"\n\nℹ️ 已达到您设置的 {limit} 条结果上限。"; break
         current_time = time.time()
@@ -717,11 +2176,11 @@ def run_traceback_download_query(context: CallbackContext):
                 break
             except (ValueError, TypeError): continue
         if not valid_anchor_found: termination_reason = "\n\n⚠️ 无法找到有效的时间锚点以继续，可能已达查询边界."; break
+    if pipeline: pipeline.finish(stopped=bool(context.bot_data.get(stop_flag)))
     if unique_results:
-        with open(output_filename, 'w', encoding='utf-8') as f: f.write("\n".join(sorted(list(unique_results))))
-        msg.edit_text(f"✅ 深度追溯完成！共 {len(unique_results)} 条。{termination_reason}\n正在发送文件...")
         cache_path = os.path.join(FOFA_CACHE_DIR, output_filename)
-        shutil.move(output_filename, cache_path)
+        write_cache_lines(cache_path, sorted(unique_results))
+        msg.edit_text(f"✅ 深度追溯完成！共 {len(unique_results)} 条。{termination_reason}\n正在发送文件...")
         send_file_safely(context, chat_id, cache_path, filename=output_filename)
         upload_and_send_links(context, chat_id, cache_path)
         cache_data = {'file_path': cache_path, 'result_count': len(unique_results)}
@@ -770,7 +2229,7 @@ def run_incremental_update_query(context: CallbackContext):
     try: msg.edit_text(f"4/5: 正在合并数据... (发现 {len(new_results)} 条新数据)")
     except (BadRequest, RetryAfter, TimedOut): pass
     combined_results = sorted(list(new_results.union(old_results)))
-    with open(old_file_path, 'w', encoding='utf-8') as f: f.write("\n".join(combined_results))
+    write_cache_lines(old_file_path, combined_results)
     try: msg.edit_text(f"5/5: 发送更新后的文件... (共 {len(combined_results)} 条)")
     except (BadRequest, RetryAfter, TimedOut): pass
     send_file_safely(context, chat_id, old_file_path)
@@ -780,24 +2239,25 @@ def run_incremental_update_query(context: CallbackContext):
     msg.delete(); bot.send_message(chat_id, f"✅ 增量更新完成！"); offer_post_download_actions(context, chat_id, base_query)
 def run_batch_download_query(context: CallbackContext):
     job_data = context.job.context; bot, chat_id, query_text, total_size, fields = context.bot, job_data['chat_id'], job_data['query'], job_data['total_size'], job_data['fields']
-    output_filename = generate_filename_from_query(query_text, prefix="batch_export", ext=".csv"); results_list, stop_flag = [], f'stop_job_{chat_id}'
+    output_filename = generate_filename_from_query(query_text, prefix="batch_export", ext=".csv"); stop_flag = f'stop_job_{chat_id}'
+    store_writer = ColumnarStoreWriter(query_text, fields.split(',')); was_stopped = False
     msg = bot.send_message(chat_id, "⏳ 开始自定义字段批量导出任务..."); pages_to_fetch = (total_size + 9999) // 10000
     for page in range(1, pages_to_fetch + 1):
-        if context.bot_data.get(stop_flag): msg.edit_text("🌀 下载任务已手动停止."); break
-        try: msg.edit_text(f"下载进度: {len(results_list)}/{total_size} (Page {page}/{pages_to_fetch})...")
+        if context.bot_data.get(stop_flag): msg.edit_text("🌀 下载任务已手动停止."); was_stopped = True; break
+        try: msg.edit_text(f"下载进度: {store_writer.row_count}/{total_size} (Page {page}/{pages_to_fetch})...")
         except (BadRequest, RetryAfter, TimedOut): pass
         data, _, _, _, _, error = execute_query_with_fallback(
             lambda key, key_level, proxy_session: fetch_fofa_data(key, query_text, page, 10000, fields, proxy_session=proxy_session)
         )
-        if error: msg.edit_text(f"❌ 第 {page} 页下载出错: {error}"); break
+        if error: msg.edit_text(f"❌ 第 {page} 页下载出错: {error}"); was_stopped = True; break
         page_results = data.get('results', [])
         if not page_results: break
-        results_list.extend(page_results)
-    if results_list:
-        msg.edit_text(f"✅ 下载完成！共 {len(results_list)} 条。正在生成CSV文件...")
+        store_writer.append_rows(page_results)
+    store_meta = store_writer.commit(complete=not was_stopped)
+    if store_meta:
+        msg.edit_text(f"✅ 下载完成！共 {store_meta['rows']} 条。正在生成CSV文件...")
         try:
-            with open(output_filename, 'w', encoding='utf-8-sig', newline='') as f:
-                writer = csv.writer(f); writer.writerow(fields.split(',')); writer.writerows(results_list)
+            export_columnar_store(store_meta, store_meta['fields'], 'csv', output_filename)
             send_file_safely(context, chat_id, output_filename, caption=f"✅ 自定义导出完成\n查询: `{escape_markdown_v2(query_text)}`", parse_mode=ParseMode.MARKDOWN_V2)
             upload_and_send_links(context, chat_id, output_filename)
         except Exception as e:
@@ -810,9 +2270,10 @@ def run_batch_download_query(context: CallbackContext):
 def run_batch_traceback_query(context: CallbackContext):
     job_data = context.job.context; bot, chat_id, base_query, fields, limit = context.bot, job_data['chat_id'], job_data['query'], job_data['fields'], job_data.get('limit')
     output_filename = generate_filename_from_query(base_query, prefix="batch_traceback", ext=".csv")
-    unique_results, page_count, last_page_date, termination_reason, stop_flag, last_update_time = [], 0, None, "", f'stop_job_{chat_id}', 0
+    page_count, last_page_date, termination_reason, stop_flag, last_update_time = 0, None, "", f'stop_job_{chat_id}', 0
     msg = bot.send_message(chat_id, "⏳ 开始自定义字段深度追溯下载...")
-    current_query = base_query; seen_hashes = set()
+    current_query = base_query; seen_hashes = set(); is_complete = False
+    store_writer = ColumnarStoreWriter(base_query, fields.split(','))
     
     # v10.9.4 FIX: 为整个追溯过程锁定一个代理会话
     locked_proxy_session = None
@@ -824,12 +2285,12 @@ def run_batch_traceback_query(context: CallbackContext):
         fields_were_extended = False
         def query_logic(key, key_level, proxy_session):
             nonlocal fields_were_extended
-            if key_level >= 1:
-                fields_were_extended = True
-                return fetch_fofa_data(key, current_query, 1, 10000, fields=fields + ",lastupdatetime", proxy_session=proxy_session)
-            else:
-                fields_were_extended = False
-                return fetch_fofa_data(key, current_query, 1, 10000, fields=fields, proxy_session=proxy_session)
+            fields_were_extended = key_capability(key)['lastupdatetime']
+            if fields_were_extended:
+                data, error = fetch_fofa_data(key, current_query, 1, 10000, fields=fields + ",lastupdatetime", proxy_session=proxy_session)
+                if not (error and KEY_FIELD_DENIED_ERROR in str(error)): return data, error
+                learn_key_capability(key, lastupdatetime=False); fields_were_extended = False
+            return fetch_fofa_data(key, current_query, 1, 10000, fields=fields, proxy_session=proxy_session)
 
         # 仅在第一次迭代时选择并锁定代理
         if locked_proxy_session is None:
@@ -839,19 +2300,20 @@ def run_batch_traceback_query(context: CallbackContext):
 
         if error: termination_reason = f"\n\n❌ 第 {page_count} 轮出错: {error}"; break
         results = data.get('results', [])
-        if not results: termination_reason = "\n\nℹ️ 已获取所有查询结果."; break
+        if not results: termination_reason = "\n\nℹ️ 已获取所有查询结果."; is_complete = True; break
 
-        newly_added_count = 0
+        new_rows = []
         for r in results:
-            r_hash = hashlib.md5(str(r).encode()).hexdigest()
+            r_hash = hashlib.md5(str(r).encode()).digest()
             if r_hash not in seen_hashes:
                 seen_hashes.add(r_hash)
-                unique_results.append(r[:-1] if fields_were_extended else r)
-                newly_added_count += 1
-        if limit and len(unique_results) >= limit: unique_results = unique_results[:limit]; termination_reason = f"\n\nℹ️ 已达到您设置的 {limit} 条结果上限。"; break
+                new_rows.append(r[:-1] if fields_were_extended else r)
+        if limit: new_rows = new_rows[:max(0, limit - store_writer.row_count)]
+        store_writer.append_rows(new_rows); newly_added_count = len(new_rows)
+        if limit and store_writer.row_count >= limit: termination_reason = f"\n\nℹ️ 已达到您设置的 {limit} 条结果上限。"; break
         current_time = time.time()
         if current_time - last_update_time > 2:
-            try: msg.edit_text(f"⏳ 已找到 {len(unique_results)} 条... (第 {page_count} 轮, 新增 {newly_added_count})")
+            try: msg.edit_text(f"⏳ 已找到 {store_writer.row_count} 条... (第 {page_count} 轮, 新增 {newly_added_count})")
             except (BadRequest, RetryAfter, TimedOut): pass
             last_update_time = current_time
 
@@ -871,11 +2333,11 @@ def run_batch_traceback_query(context: CallbackContext):
                 break
             except (ValueError, TypeError): continue
         if not valid_anchor_found: termination_reason = "\n\n⚠️ 无法找到有效的时间锚点以继续，可能已达查询边界."; break
-    if unique_results:
-        msg.edit_text(f"✅ 追溯完成！共 {len(unique_results)} 条。{termination_reason}\n正在生成CSV...")
+    store_meta = store_writer.commit(complete=is_complete)
+    if store_meta:
+        msg.edit_text(f"✅ 追溯完成！共 {store_meta['rows']} 条。{termination_reason}\n正在生成CSV...")
         try:
-            with open(output_filename, 'w', encoding='utf-8-sig', newline='') as f:
-                writer = csv.writer(f); writer.writerow(fields.split(',')); writer.writerows(unique_results)
+            export_columnar_store(store_meta, store_meta['fields'], 'csv', output_filename)
             send_file_safely(context, chat_id, output_filename)
             upload_and_send_links(context, chat_id, output_filename)
         except Exception as e:
@@ -909,13 +2371,15 @@ def start_command(update: Update, context: CallbackContext):
 
 def help_command(update: Update, context: CallbackContext):
     help_text = ( "📖 *Fofa 机器人指令手册 v10\\.9*\n\n"
-                  "*🔍 资产搜索 \\(常规\\)*\n`/kkfofa [key] <query>`\n_FOFA搜索, 适用于1万条以内数据_\n\n"
-                  "*🚚 资产搜索 \\(海量\\)*\n`/allfofa <query>`\n_使用next接口稳定获取海量数据 \\(管理员\\)_\n\n"
-                  "*📦 主机详查 \\(智能\\)*\n`/host <ip|domain>`\n_自适应获取最全主机信息 \\(管理员\\)_\n\n"
-                  "*🔬 主机速查 \\(聚合\\)*\n`/lowhost <ip|domain> [detail]`\n_快速获取主机聚合信息 \\(所有用户\\)_\n\n"
-                  "*📊 聚合统计*\n`/stats <query>`\n_获取全局聚合统计 \\(管理员\\)_\n\n"
+                  "*🔍 资产搜索 \\(常规\\)*\n`/kkfofa [key] <query> [--scan]`\n_FOFA搜索, 适用于1万条以内数据; `--scan` 下载时同步探测存活 \\(管理员\\)_\n\n"
+                  "*🚚 资产搜索 \\(海量\\)*\n`/allfofa <query> [--scan]`\n_使用next接口稳定获取海量数据 \\(管理员\\)_\n\n"
+                  "*📦 主机详查 \\(智能\\)*\n`/host <ip|domain> [更多目标\\.\\.\\.] [fresh]`\n_优先使用本地索引与缓存, 多个目标并发查询, 也可回复 \\.txt 文件 \\(管理员\\)_\n\n"
+                  "*🔬 主机速查 \\(聚合\\)*\n`/lowhost <ip|domain> [更多目标\\.\\.\\.] [detail]`\n_快速获取主机聚合信息, 支持多目标 \\(所有用户\\)_\n\n"
+                  "*📊 聚合统计*\n`/stats <query>`\n_获取全局聚合统计 \\(管理员\\)_\n`/stats local [top=N] [by=port:country] <query>`\n_基于本地缓存离线统计, 支持任意字段与交叉统计_\n\n"
                   "*📂 批量智能分析*\n`/batchfind`\n_上传IP列表, 分析特征并生成Excel \\(管理员\\)_\n\n"
-                  "*📤 批量自定义导出 \\(交互式\\)*\n`/batch <query>`\n_进入交互式菜单选择字段导出 \\(管理员\\)_\n\n"
+                  "*📤 批量自定义导出 \\(交互式\\)*\n`/batch <query>`\n_进入交互式菜单选择字段导出, 已有本地列存时可离线重新导出 \\(管理员\\)_\n\n"
+                  "*👁 缓存预览*\n`/view <query|#编号> [页码]`\n_在Telegram内分页浏览本地缓存, 无需下载文件 \\(管理员\\)_\n\n"
+                  "*🧮 缓存集合运算*\n`/diff #A #B` `/union #A #B` `/intersect #A #B`\n_对两份本地缓存做差集/并集/交集, 流式归并无需重新查询 \\(管理员\\)_\n\n"
                   "*⚙️ 管理与设置*\n`/settings`\n_进入交互式设置菜单 \\(管理员\\)_\n\n"
                   "*🔑 Key管理*\n`/batchcheckapi`\n_上传文件批量验证API Key \\(管理员\\)_\n\n"
                   "*💻 系统管理*\n"
@@ -953,6 +2417,7 @@ def query_entry_point(update: Update, context: CallbackContext):
             preset = CONFIG["presets"][preset_index]
             context.user_data['original_query'] = preset['query']
             context.user_data['key_index'] = None
+            context.user_data['pipeline_scan'] = False
             keyboard = [[InlineKeyboardButton("🌍 是的, 限定大洲", callback_data="continent_select"), InlineKeyboardButton("⏩ 不, 直接搜索", callback_data="continent_skip")]]
             query_obj.message.edit_text(f"预设查询: `{escape_markdown_v2(preset['query'])}`\n\n是否要将此查询限定在特定大洲范围内？", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
             return QUERY_STATE_ASK_CONTINENT
@@ -976,6 +2441,10 @@ def query_entry_point(update: Update, context: CallbackContext):
                 return STATE_GET_GUEST_KEY
             context.user_data['guest_key'] = guest_key
 
+        # --scan: 下载时同步对新结果做TCP存活探测 (仅管理员)
+        context.user_data['pipeline_scan'] = '--scan' in context.args and is_admin(user_id)
+        context.args = [arg for arg in context.args if arg != '--scan']
+
         if not context.args:
             if command == '/kkfofa':
                 presets = CONFIG.get("presets", [])
@@ -1225,43 +2694,79 @@ def format_full_host_report(host_arg, results, fields_list):
         if d.get('banner'): port_info.append(f"  - *Banner:* ```\n{d.get('banner')}\n```")
         report.append("\n".join(port_info))
     return "\n".join(report)
-def host_command_logic(update: Update, context: CallbackContext):
-    if not context.args:
-        update.message.reply_text(f"用法: `/host <ip_or_domain>`\n\n示例:\n`/host 1\\.1\\.1\\.1`", parse_mode=ParseMode.MARKDOWN_V2)
-        return
-    host_arg = context.args[0]
-    processing_message = update.message.reply_text(f"⏳ 正在查询主机 `{escape_markdown_v2(host_arg)}`\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
+HOST_REPORT_TTL, HOST_REPORT_CACHE_SIZE = 3600, 1000 # 主机报告缓存的有效期(秒)与条目上限
+HOST_REPORT_MAX_CHARS = 3800 # 超过此长度的报告改为文件发送
+HOST_BATCH_MAX_TARGETS, HOST_BATCH_GUEST_MAX_TARGETS = 500, 10 # 单次 /host、/lowhost 的目标上限 (管理员 / 普通用户)
+HOST_BATCH_MAX_WORKERS = 8 # 实际线程数为 min(此值, 有效Key数 x 2)
+HOST_REPORT_SEPARATOR = "\n\n━━━━━━━━━━━━━━\n\n"
+
+class HostReportCache:
+    """
+    内存中的主机报告缓存，键为 (命令, 目标, 参数)。条目超过 ttl 秒即过期，超出容量时淘汰最久未使用的条目。
+    批量查询的多个线程共享同一实例，所有操作都加锁。
+    """
+    def __init__(self, ttl=HOST_REPORT_TTL, max_size=HOST_REPORT_CACHE_SIZE):
+        self.ttl, self.max_size, self._lock, self._entries = ttl, max_size, threading.Lock(), OrderedDict()
+
+    def __len__(self):
+        with self._lock: return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            if time.monotonic() - entry[0] > self.ttl: del self._entries[key]; return None
+            self._entries.move_to_end(key); return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value); self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size: self._entries.popitem(last=False)
+HOST_REPORTS = HostReportCache()
+
+def plain_host_report(text):
+    """去掉 MarkdownV2 标记，用于写入报告文件。"""
+    return re.sub(r'([*_`\[\]\\])', '', text)
+
+def fallback_host_query(query_func):
+    """单目标查询沿用 execute_query_with_fallback 的Key轮换，返回 (data, error)。"""
+    data, _, _, _, _, error = execute_query_with_fallback(query_func)
+    return data, error
+
+def lookup_host_report(host_arg, force_remote, run_query, indexed=None):
+    """
+    生成单个目标的 /host 报告，返回 (result, error)；未找到任何信息时两者均为 None。
+    result = {'report', 'summary', 'notes', 'source'}，notes 为本地索引命中等附加说明，source 为 cache/local/remote。
+    run_query(query_func) 返回 (data, error)，单目标时为 fallback_host_query，批量时为 FofaKeyPool.query。
+    indexed 为批量查询预先取好的 (索引命中, (fields, rows))，省略时自行查询本地索引。
+    """
+    cache_key = ('host', host_arg)
+    if not force_remote:
+        cached = HOST_REPORTS.get(cache_key)
+        if cached: return dict(cached, source='cache'), None
     query = f'ip="{host_arg}"' if re.match(r"^\d{1,3}(\.\d{1,3}){3}$", host_arg) else f'domain="{host_arg}"'
-    data, final_fields_list, error = None, [], None
-    for level in range(3, -1, -1): 
-        fields_to_try = get_fields_by_level(level)
-        fields_str = ",".join(fields_to_try)
-        try:
-            processing_message.edit_text(f"⏳ 正在尝试以 *等级 {level}* 字段查询\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        except (BadRequest, RetryAfter, TimedOut):
-            time.sleep(1)
-        temp_data, _, _, _, _, temp_error = execute_query_with_fallback(
-            lambda key, key_level, proxy_session: fetch_fofa_data(key, query, page_size=100, fields=fields_str, proxy_session=proxy_session)
-        )
-        if not temp_error:
-            data = temp_data
-            final_fields_list = fields_to_try
-            error = None
-            break
-        if "[820001]" not in str(temp_error):
-            error = temp_error
-            break
-        else:
-            error = temp_error
-            continue
-    if error:
-        processing_message.edit_text(f"查询失败 😞\n*原因:* `{escape_markdown_v2(error)}`", parse_mode=ParseMode.MARKDOWN_V2)
-        return
+    data, final_fields_list, notes, source = None, [], [], 'remote'
+    index_hits, local = indexed if indexed is not None else (lookup_host_index(host_arg), None)
+    if index_hits:
+        matched_lines = [f"📂 *本地索引命中 {len(index_hits)} 条记录:*"]
+        matched_lines += [f"  `{escape_markdown_v2(q)}`: {n} 条" for q, n in summarize_index_hits(index_hits)[:10]]
+        notes.append("\n".join(matched_lines))
+        if not force_remote:
+            local_fields, local_rows = local if local is not None else load_indexed_host_rows(index_hits)
+            if local_rows:
+                data, final_fields_list, source = {'results': local_rows}, local_fields, 'local'
+                notes.append(f"ℹ️ 以下报告来自本地列存，发送 `/host {escape_markdown_v2(host_arg)} fresh` 可强制在线查询\\.")
+    if data is None:
+        # 每个Key按能力缓存直接选用可用的最高等级字段，不再逐级试错
+        def query_logic(key, key_level, proxy_session):
+            nonlocal final_fields_list
+            data, error, final_fields_list = fetch_with_key_fields(key, query, page_size=100, proxy_session=proxy_session)
+            return data, error
+        data, error = run_query(query_logic)
+        if error: return None, error
     raw_results = data.get('results', [])
-    if not raw_results:
-        processing_message.edit_text(f"🤷‍♀️ 未找到关于 `{escape_markdown_v2(host_arg)}` 的任何信息\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        return
-    
+    if not raw_results: return None, None
+
     unique_services = {}
     ip_idx = final_fields_list.index('ip') if 'ip' in final_fields_list else -1
     port_idx = final_fields_list.index('port') if 'port' in final_fields_list else -1
@@ -1276,20 +2781,15 @@ def host_command_logic(update: Update, context: CallbackContext):
     else:
         results = raw_results
 
-    full_report = format_full_host_report(host_arg, results, final_fields_list)
-    if len(full_report) > 3800:
-        summary_report = create_host_summary(host_arg, results, final_fields_list)
-        processing_message.edit_text(summary_report, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
-        report_filename = f"host_details_{host_arg.replace('.', '_')}.txt"
-        try:
-            plain_text_report = re.sub(r'([*_`\[\]\\])', '', full_report)
-            with open(report_filename, 'w', encoding='utf-8') as f: f.write(plain_text_report)
-            send_file_safely(context, update.effective_chat.id, report_filename, caption="📄 完整的详细报告已附上。")
-            upload_and_send_links(context, update.effective_chat.id, report_filename)
-        finally:
-            if os.path.exists(report_filename): os.remove(report_filename)
-    else:
-        processing_message.edit_text(full_report, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+    result = {'report': format_full_host_report(host_arg, results, final_fields_list), 'summary': create_host_summary(host_arg, results, final_fields_list), 'notes': notes, 'source': source}
+    HOST_REPORTS.put(cache_key, result)
+    return result, None
+def host_command_logic(update: Update, context: CallbackContext):
+    targets, force_remote = parse_host_targets(update, context, 'fresh')
+    if not targets:
+        update.message.reply_text(f"用法: `/host <ip_or_domain> [更多目标\\.\\.\\.] [fresh]`\n\n示例:\n`/host 1\\.1\\.1\\.1`\n`/host 1\\.1\\.1\\.1 8\\.8\\.8\\.8 example\\.com`\n\n也可以回复一个每行一个目标的 \\.txt 文件发送 `/host` 进行批量查询\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        return
+    start_host_lookup(update, context, 'host', targets, force_remote)
 @admin_only
 def host_command(update: Update, context: CallbackContext):
     host_command_logic(update, context)
@@ -1326,38 +2826,144 @@ def format_host_details(data):
         details.append(port_str)
     full_report = summary + "\n".join(details)
     return full_report
-def lowhost_command(update: Update, context: CallbackContext) -> None:
-    if not context.args:
-        update.message.reply_text("用法: `/lowhost <ip_or_domain> [detail]`\n\n示例:\n`/lowhost 1\\.1\\.1\\.1`\n`/lowhost example\\.com detail`", parse_mode=ParseMode.MARKDOWN_V2)
-        return
-    host = context.args[0]
-    detail = len(context.args) > 1 and context.args[1].lower() == 'detail'
-    processing_message = update.message.reply_text(f"正在查询主机 `{escape_markdown_v2(host)}` 的聚合信息\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    data, _, _, _, _, error = execute_query_with_fallback(
-        lambda key, key_level, proxy_session: fetch_fofa_host_info(key, host, detail, proxy_session=proxy_session)
-    )
+def lookup_lowhost_report(host, detail, run_query):
+    """生成单个目标的 /lowhost 报告，返回值约定同 lookup_host_report。"""
+    cache_key = ('lowhost', host, detail)
+    cached = HOST_REPORTS.get(cache_key)
+    if cached: return dict(cached, source='cache'), None
+    data, error = run_query(lambda key, key_level, proxy_session: fetch_fofa_host_info(key, host, detail, proxy_session=proxy_session))
+    if error: return None, error
+    if not data: return None, None
+    result = {'report': format_host_details(data) if detail else format_host_summary(data), 'summary': None, 'notes': [], 'source': 'remote'}
+    HOST_REPORTS.put(cache_key, result)
+    return result, None
+
+def parse_host_targets(update: Update, context: CallbackContext, flag):
+    """
+    从命令参数 (空格或逗号分隔) 以及被回复的文本文件中收集目标，返回 (去重后的目标列表, 是否带有 flag 参数)。
+    flag 可以出现在任意位置。
+    超出上限的目标会被截断并提示。
+    """
+    args = [part for arg in (context.args or []) for part in arg.split(',') if part.strip()]
+    option = any(arg.lower() == flag for arg in args)
+    targets = [arg.strip() for arg in args if arg.lower() != flag]
+    reply = update.message.reply_to_message
+    if reply and reply.document:
+        file_path = os.path.join(FOFA_CACHE_DIR, f"host_targets_{update.effective_chat.id}_{int(time.time())}.txt")
+        try:
+            reply.document.get_file().download(custom_path=file_path)
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f: targets += [line.strip() for line in f if line.strip()]
+        except Exception as e: update.message.reply_text(f"❌ 读取文件失败: {e}")
+        finally:
+            if os.path.exists(file_path): os.remove(file_path)
+    targets = list(dict.fromkeys(targets))
+    limit = HOST_BATCH_MAX_TARGETS if is_admin(update.effective_user.id) else HOST_BATCH_GUEST_MAX_TARGETS
+    if len(targets) > limit:
+        update.message.reply_text(f"⚠️ 目标过多，仅查询前 {limit} 个 (共 {len(targets)} 个)。"); targets = targets[:limit]
+    return targets, option
+
+def start_host_lookup(update: Update, context: CallbackContext, kind, targets, option):
+    """发送处理中提示后把查询交给后台任务，不占用 dispatcher 线程。"""
+    chat_id = update.effective_chat.id
+    if len(targets) == 1:
+        text = f"⏳ 正在查询主机 `{escape_markdown_v2(targets[0])}`\\.\\.\\." if kind == 'host' else f"正在查询主机 `{escape_markdown_v2(targets[0])}` 的聚合信息\\.\\.\\."
+    else: text = f"⏳ 正在并发查询 {len(targets)} 个目标\\.\\.\\."
+    msg = update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+    job_data = {'chat_id': chat_id, 'kind': kind, 'targets': targets, 'option': option, 'msg': msg}
+    context.job_queue.run_once(run_host_lookup_job, 0, context=job_data, name=f"{kind}_lookup_{chat_id}_{msg.message_id}")
+
+def send_single_host_report(context: CallbackContext, job_data, result, error):
+    chat_id, kind, target, msg = job_data['chat_id'], job_data['kind'], job_data['targets'][0], job_data['msg']
     if error:
-        processing_message.edit_text(f"查询失败 😞\n*原因:* `{escape_markdown_v2(error)}`", parse_mode=ParseMode.MARKDOWN_V2)
+        msg.edit_text(f"查询失败 😞\n*原因:* `{escape_markdown_v2(error)}`", parse_mode=ParseMode.MARKDOWN_V2)
         return
-    if not data:
-        processing_message.edit_text(f"🤷‍♀️ 未找到关于 `{escape_markdown_v2(host)}` 的任何信息\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    if result is None:
+        msg.edit_text(f"🤷‍♀️ 未找到关于 `{escape_markdown_v2(target)}` 的任何信息\\.", parse_mode=ParseMode.MARKDOWN_V2)
         return
-    if detail:
-        formatted_text = format_host_details(data)
-    else:
-        formatted_text = format_host_summary(data)
-    if len(formatted_text) > 3800:
-        processing_message.edit_text("报告过长，将作为文件发送。")
-        report_filename = f"lowhost_details_{host.replace('.', '_')}.txt"
+    if result['source'] != 'cache':
+        for note in result['notes']: context.bot.send_message(chat_id, note, parse_mode=ParseMode.MARKDOWN_V2)
+    if len(result['report']) > HOST_REPORT_MAX_CHARS:
+        if result['summary']: msg.edit_text(result['summary'], parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+        else: msg.edit_text("报告过长，将作为文件发送。")
+        report_filename = f"{kind}_details_{target.replace('.', '_')}.txt"
         try:
-            plain_text_report = re.sub(r'([*_`\[\]\\])', '', formatted_text)
-            with open(report_filename, 'w', encoding='utf-8') as f: f.write(plain_text_report)
-            send_file_safely(context, update.effective_chat.id, report_filename, caption="📄 完整的聚合报告已附上。")
-            upload_and_send_links(context, update.effective_chat.id, report_filename)
+            with open(report_filename, 'w', encoding='utf-8') as f: f.write(plain_host_report(result['report']))
+            send_file_safely(context, chat_id, report_filename, caption="📄 完整的详细报告已附上。" if kind == 'host' else "📄 完整的聚合报告已附上。")
+            upload_and_send_links(context, chat_id, report_filename)
         finally:
             if os.path.exists(report_filename): os.remove(report_filename)
     else:
-        processing_message.edit_text(formatted_text, parse_mode=ParseMode.MARKDOWN_V2)
+        msg.edit_text(result['report'], parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+
+def run_host_lookup_job(context: CallbackContext):
+    job_data = context.job.context; chat_id, kind, targets, option, msg = job_data['chat_id'], job_data['kind'], job_data['targets'], job_data['option'], job_data['msg']
+    if len(targets) == 1:
+        result, error = (lookup_host_report if kind == 'host' else lookup_lowhost_report)(targets[0], option, fallback_host_query)
+        send_single_host_report(context, job_data, result, error)
+        return
+    key_pool = FofaKeyPool([key for key in CONFIG['apis'] if KEY_LEVELS.get(key, -1) >= 0])
+    workers = max(1, min(HOST_BATCH_MAX_WORKERS, 2 * len(key_pool)))
+    # /host 先为所有未缓存的目标统一查询本地索引，命中同一列存的目标合并读取，每个列存只扫描一遍
+    indexed = {}
+    if kind == 'host':
+        try:
+            pending_targets = [target for target in targets if option or HOST_REPORTS.get(('host', target)) is None]
+            hits_by_target = lookup_host_index_many(pending_targets)
+            loaded = {} if option else load_indexed_host_rows_many(hits_by_target)
+            indexed = {target: (hits_by_target.get(target, []), loaded.get(target, (None, []))) for target in pending_targets}
+        except Exception as e: logger.error(f"批量主机查询读取本地索引失败: {e}")
+
+    def lookup_one(target):
+        try: return lookup_host_report(target, option, key_pool.query, indexed.get(target)) if kind == 'host' else lookup_lowhost_report(target, option, key_pool.query)
+        except Exception as e: logger.error(f"主机查询 {target} 失败: {e}"); return None, str(e)
+
+    # 结果按输入顺序汇总：较短时拼成一条消息，一旦超过长度上限就把已有部分和后续结果逐个写入文件。
+    # 收到停止信号后取消尚未开始的查询，只等待在途的查询完成。
+    counts = {'cache': 0, 'local': 0, 'remote': 0, 'missing': 0, 'error': 0, 'skipped': 0}
+    title = "主机聚合报告" if kind == 'host' else "主机聚合摘要"
+    sections, length, report_file, report_filename, last_update_time = [f"📋 *批量{title}* \\({len(targets)} 个目标\\)"], 0, None, None, 0
+    stop_flag, stopped = register_stop_key(context, chat_id, f"{kind}_lookup"), False
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(lookup_one, target) for target in targets]
+            for done, (target, future) in enumerate(zip(targets, futures), 1):
+                if not stopped and context.bot_data.get(stop_flag):
+                    stopped = True
+                    for pending in futures: pending.cancel()
+                if future.cancelled(): counts['skipped'] += 1; continue
+                result, error = future.result()
+                if error: counts['error'] += 1; section = f"❌ `{escape_markdown_v2(target)}`: {escape_markdown_v2(error)}"
+                elif result is None: counts['missing'] += 1; section = f"🤷‍♀️ `{escape_markdown_v2(target)}`: 未找到任何信息"
+                else: counts[result['source']] += 1; section = result['report']
+                if report_file is None and length + len(section) > HOST_REPORT_MAX_CHARS:
+                    report_filename = generate_filename_from_query(" ".join(targets[:3]), prefix=f"{kind}_batch")
+                    report_file = open(report_filename, 'w', encoding='utf-8'); report_file.write(plain_host_report(HOST_REPORT_SEPARATOR.join(sections)))
+                if report_file: report_file.write(plain_host_report(HOST_REPORT_SEPARATOR + section))
+                else: sections.append(section); length += len(section) + len(HOST_REPORT_SEPARATOR)
+                if time.time() - last_update_time > 2:
+                    try: msg.edit_text(f"查询进度: {create_progress_bar(done/len(targets)*100)} ({done}/{len(targets)}, 并发 {workers})")
+                    except (BadRequest, RetryAfter, TimedOut): pass
+                    last_update_time = time.time()
+        stats = f"缓存命中 {counts['cache']}, 本地列存 {counts['local']}, 在线查询 {counts['remote']}, 未找到 {counts['missing']}, 失败 {counts['error']}"
+        if counts['skipped']: stats += f", 已停止, 未查询 {counts['skipped']}"
+        if report_file:
+            report_file.close()
+            msg.edit_text(f"{'🌀 任务已停止' if stopped else '✅ 查询完成'}，报告过长，将作为文件发送。\n{stats}")
+            send_file_safely(context, chat_id, report_filename, caption=f"📄 {len(targets)} 个目标的{title} ({stats})")
+            upload_and_send_links(context, chat_id, report_filename)
+        else:
+            msg.edit_text(HOST_REPORT_SEPARATOR.join(sections) + f"\n\n_{escape_markdown_v2(stats)}_", parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
+    finally:
+        release_stop_key(context, chat_id, stop_flag)
+        if report_file: report_file.close()
+        if report_filename and os.path.exists(report_filename): os.remove(report_filename)
+
+def lowhost_command(update: Update, context: CallbackContext) -> None:
+    targets, detail = parse_host_targets(update, context, 'detail')
+    if not targets:
+        update.message.reply_text("用法: `/lowhost <ip_or_domain> [更多目标\\.\\.\\.] [detail]`\n\n示例:\n`/lowhost 1\\.1\\.1\\.1`\n`/lowhost example\\.com detail`\n`/lowhost 1\\.1\\.1\\.1 8\\.8\\.8\\.8`\n\n也可以回复一个每行一个目标的 \\.txt 文件发送 `/lowhost` 进行批量查询\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        return
+    start_host_lookup(update, context, 'lowhost', targets, detail)
 
 # --- /stats 命令 ---
 @admin_only
@@ -1368,6 +2974,9 @@ def stats_command(update: Update, context: CallbackContext):
     return get_fofa_stats_query(update, context)
 def get_fofa_stats_query(update: Update, context: CallbackContext):
     query_text = " ".join(context.args) if context.args else update.message.text
+    tokens = query_text.split()
+    if tokens and tokens[0].lower() == 'local':
+        return get_local_stats_query(update, context, tokens[1:])
     msg = update.message.reply_text(f"⏳ 正在对 `{escape_markdown_v2(query_text)}` 进行聚合统计\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
     
     data, _, _, _, _, error = execute_query_with_fallback(
@@ -1431,15 +3040,195 @@ def get_fofa_stats_query(update: Update, context: CallbackContext):
 
     return ConversationHandler.END
 
+# --- /stats local: 基于本地缓存的聚合统计 ---
+LOCAL_STATS_SKIP_FIELDS = {'header', 'banner', 'body', 'cert', 'structinfo', 'icon', 'lastupdatetime'}
+def parse_local_stats_args(tokens):
+    """解析 `top=N fields=a,b by=a:b` 形式的前置参数，返回 (top_n, fields, cross, query_text)。"""
+    top_n, fields, cross = 5, None, []
+    while tokens:
+        match = re.match(r'^(top|fields|by)=(\S+)$', tokens[0], re.IGNORECASE)
+        if not match: break
+        name, value = match.group(1).lower(), match.group(2); tokens = tokens[1:]
+        if name == 'top' and value.isdigit(): top_n = max(1, int(value))
+        elif name == 'fields': fields = [f for f in value.split(',') if f]
+        elif name == 'by' and ':' in value: cross.append(tuple(value.split(':', 1)))
+    return top_n, fields, cross, " ".join(tokens)
+def compute_local_stats(df, fields, cross):
+    """返回完整频数表 {字段: Series} 和交叉统计 {(a, b): Series}，空值不计入。"""
+    tables = {}
+    for field in fields:
+        column = df[field].astype(str)
+        tables[field] = column[column != ''].value_counts()
+    crosstabs = {}
+    for a, b in cross:
+        pair = df[[a, b]].astype(str)
+        pair = pair[(pair[a] != '') & (pair[b] != '')]
+        crosstabs[(a, b)] = pair.groupby([a, b], sort=False).size().sort_values(ascending=False)
+    return tables, crosstabs
+def write_local_stats_workbook(filename, tables, crosstabs):
+    used_names = set()
+    def sheet_name(name):
+        name = re.sub(r'[\[\]:*?/\\]', '_', name)[:28]; candidate, i = name, 1
+        while candidate in used_names: candidate = f"{name}_{i}"; i += 1
+        used_names.add(candidate); return candidate
+    with pd.ExcelWriter(filename, engine='openpyxl') as writer:
+        for field, counts in tables.items():
+            frame = counts.rename_axis(field).reset_index(name='count')
+            frame['percent'] = (frame['count'] / frame['count'].sum() * 100).round(2)
+            frame.to_excel(writer, sheet_name=sheet_name(field), index=False)
+        for (a, b), counts in crosstabs.items():
+            counts.reset_index(name='count').to_excel(writer, sheet_name=sheet_name(f"{a}_x_{b}"), index=False)
+def get_local_stats_query(update: Update, context: CallbackContext, tokens):
+    top_n, fields, cross, query_text = parse_local_stats_args(tokens)
+    if not query_text:
+        update.message.reply_text("用法: `/stats local [top=N] [fields=a,b] [by=port:country] <query>`", parse_mode=ParseMode.MARKDOWN_V2)
+        return ConversationHandler.END
+    started = time.time()
+    needed = list(fields or []) + [c for pair in cross for c in pair]
+    try:
+        df, source = load_cached_frame(query_text, list(dict.fromkeys(needed)) or None)
+    except Exception as e:
+        update.message.reply_text(f"❌ 读取本地缓存失败: {e}"); return ConversationHandler.END
+    if df is None:
+        update.message.reply_text("❌ 没有找到该查询的本地缓存，请先通过 /kkfofa 或 /batch 下载。"); return ConversationHandler.END
+    missing = [c for c in needed if c not in df.columns]
+    if missing:
+        available_df, _ = load_cached_frame(query_text)
+        update.message.reply_text(f"❌ 本地缓存中没有字段: {', '.join(missing)}\n可用字段: {', '.join(available_df.columns)}")
+        return ConversationHandler.END
+    if not fields: fields = [c for c in df.columns if c not in LOCAL_STATS_SKIP_FIELDS]
+    tables, crosstabs = compute_local_stats(df, fields, cross)
+    elapsed_ms = (time.time() - started) * 1000
+
+    report = [f"📊 *本地聚合统计 for `{escape_markdown_v2_code(query_text)}`*", f"_来源: {escape_markdown_v2(source)}, 耗时 {escape_markdown_v2(f'{elapsed_ms:.0f}')} ms_\n"]
+    for field, counts in tables.items():
+        report.append(f"*{escape_markdown_v2(f'Top {top_n} {field}')}* \\({len(counts):,} 个不同值\\):")
+        for name, count in counts.head(top_n).items():
+            report.append(f"  `{escape_markdown_v2_code(name)}`: *{count:,}*")
+        report.append("")
+    for (a, b), counts in crosstabs.items():
+        report.append(f"*{escape_markdown_v2(f'Top {top_n} {a} × {b}')}*:")
+        for (value_a, value_b), count in counts.head(top_n).items():
+            report.append(f"  `{escape_markdown_v2_code(value_a)}` / `{escape_markdown_v2_code(value_b)}`: *{count:,}*")
+        report.append("")
+    report_text = "\n".join(report)
+    if len(report_text) > 3800:
+        update.message.reply_text(f"✅ 本地统计完成 ({elapsed_ms:.0f} ms)，报告过长，完整频数表将作为文件发送。")
+    else:
+        try: update.message.reply_text(report_text, parse_mode=ParseMode.MARKDOWN_V2)
+        except BadRequest as e: logger.warning(f"本地统计报告格式无效，改为纯文本发送: {e}"); update.message.reply_text(re.sub(r'\\(.)', r'\1', report_text))
+
+    if any(len(counts) > top_n for counts in list(tables.values()) + list(crosstabs.values())) or len(report_text) > 3800:
+        report_filename = generate_filename_from_query(query_text, prefix="stats_local", ext=".xlsx")
+        try:
+            write_local_stats_workbook(report_filename, tables, crosstabs)
+            send_file_safely(context, update.effective_chat.id, report_filename, caption="📄 完整频数表与交叉统计")
+        except Exception as e:
+            logger.error(f"生成本地统计文件失败: {e}")
+            update.message.reply_text(f"⚠️ 生成完整频数表失败: {e}")
+        finally:
+            if os.path.exists(report_filename): os.remove(report_filename)
+    return ConversationHandler.END
+
+# --- 内联查询 ---
+# Telegram 约 10 秒后就不再接受内联应答，而且用户每输入一个字符都会触发一次查询。
+# 因此内联查询单独走快速路径: 先查缓存，再按用户防抖，FOFA 请求只发一次且有总时限，超时就用缓存顶上。
+INLINE_DEBOUNCE = 0.6 # 同一用户在此时间内继续输入时，放弃旧的查询(秒)
+INLINE_DEADLINE = 7.0 # 从收到内联查询到应答的总时限(秒)
+INLINE_REQUEST_TIMEOUT = 5 # 单次 FOFA 请求的超时(秒)，不重试
+INLINE_CACHE_TTL, INLINE_CACHE_SIZE = 600, 256
+INLINE_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="inline")
+
+class InlineResultCache(HostReportCache):
+    """内联查询结果的 LRU 缓存，值为 [(host, title), ...]。closest() 在超时时找出与当前输入互为前缀且长度最接近的缓存结果。"""
+    def closest(self, query):
+        with self._lock:
+            now, best = time.monotonic(), None
+            for cached_query, (stored_at, rows) in self._entries.items():
+                if now - stored_at > self.ttl or not (query.startswith(cached_query) or cached_query.startswith(query)): continue
+                if best is None or abs(len(cached_query) - len(query)) < abs(len(best[0]) - len(query)): best = (cached_query, rows)
+            return best
+INLINE_RESULTS = InlineResultCache(INLINE_CACHE_TTL, INLINE_CACHE_SIZE)
+_INLINE_LOCK, _INLINE_LATEST, _INLINE_PENDING = threading.Lock(), {}, {}
+
+def fetch_inline_results(query_text):
+    """在后台线程中执行: 每个Key只请求一次。成功的结果写入缓存，即使已错过这次应答，下一次输入也能直接命中。"""
+    data, _, _, _, _, error = execute_query_with_fallback(
+        lambda key, key_level, proxy_session: fetch_fofa_data(key, query_text, page_size=10, fields="host,title", proxy_session=proxy_session, timeout=INLINE_REQUEST_TIMEOUT, retries=1)
+    )
+    if error: return None, error
+    rows = [(result[0] if result else "N/A", result[1] if len(result) > 1 else "无标题") for result in data.get('results', [])]
+    INLINE_RESULTS.put(query_text, rows)
+    return rows, None
+
+def build_inline_articles(query_text, rows, note=None):
+    if not rows:
+        return [InlineQueryResultArticle(
+            id='no_results',
+            title="未找到结果",
+            description=f"查询: {query_text}",
+            input_message_content=InputTextMessageContent(f"对于查询 '{query_text}'，FOFA 未返回任何结果。")
+        )]
+    articles = [InlineQueryResultArticle(id=str(uuid.uuid4()), title=host, description=title, input_message_content=InputTextMessageContent(host)) for host, title in rows]
+    if note: articles.insert(0, InlineQueryResultArticle(id='note', title=note, description=f"当前输入: {query_text}", input_message_content=InputTextMessageContent(note)))
+    return articles
+
+def inline_error_articles(query_text, error):
+    return [InlineQueryResultArticle(id='error', title="查询出错", description=str(error), input_message_content=InputTextMessageContent(f"FOFA 查询失败: {error}"))]
+
+def inline_timeout_articles(query_text):
+    """超过时限: 先返回最接近的缓存结果，后台查询完成后会写入缓存"""
+    closest = INLINE_RESULTS.closest(query_text)
+    if closest: return build_inline_articles(query_text, closest[1], note=f"⏳ 查询仍在进行，以下为 {closest[0]} 的缓存结果")
+    return [InlineQueryResultArticle(
+        id='pending',
+        title="⏳ 查询仍在进行...",
+        description="FOFA 响应较慢，稍后再次输入即可获得结果",
+        input_message_content=InputTextMessageContent(f"FOFA 查询 '{query_text}' 仍在进行，请稍后重试。")
+    )]
+
+def answer_inline_query(inline_query, results, cache_time=10):
+    """应答内联查询，并清除该用户仍指向这次查询的防抖记录。"""
+    with _INLINE_LOCK:
+        if _INLINE_LATEST.get(inline_query.from_user.id) == inline_query.id: del _INLINE_LATEST[inline_query.from_user.id]
+    try: inline_query.answer(results, cache_time=cache_time)
+    except BadRequest as e: logger.warning(f"内联查询应答失败: {e}")
+
+def run_inline_query_job(context: CallbackContext):
+    """防抖到期后执行: 用户已有更新的输入就放弃；否则提交查询，由查询完成回调或时限任务二者之一应答，不阻塞任何线程。"""
+    inline_query, started = context.job.context['inline_query'], context.job.context['started']
+    query_text = inline_query.query
+    with _INLINE_LOCK:
+        if _INLINE_LATEST.get(inline_query.from_user.id) != inline_query.id: return
+        # 相同的查询仍在进行时复用它，不重复请求
+        for pending_query in [q for q, f in _INLINE_PENDING.items() if f.done()]: del _INLINE_PENDING[pending_query]
+        future = _INLINE_PENDING.get(query_text) or _INLINE_PENDING.setdefault(query_text, INLINE_EXECUTOR.submit(fetch_inline_results, query_text))
+    answer_lock, answered = threading.Lock(), []
+    def answer_once(results, cache_time):
+        with answer_lock:
+            if answered: return
+            answered.append(True)
+        answer_inline_query(inline_query, results, cache_time)
+    deadline_job = context.job_queue.run_once(lambda ctx: answer_once(inline_timeout_articles(query_text), 0), max(0.5, INLINE_DEADLINE - (time.monotonic() - started)))
+    def on_done(done_future):
+        deadline_job.schedule_removal()
+        try:
+            rows, error = done_future.result()
+            answer_once(inline_error_articles(query_text, error) if error else build_inline_articles(query_text, rows), 10)
+        except Exception as e:
+            logger.error(f"内联查询时发生严重错误: {e}", exc_info=True)
+            answer_once(inline_error_articles(query_text, e), 0)
+    future.add_done_callback(on_done)
+
 def inline_fofa_handler(update: Update, context: CallbackContext) -> None:
-    """处理内联查询请求"""
-    query_text = update.inline_query.query
-    results = []
+    """处理内联查询请求。缓存命中时立即应答，否则交给 JobQueue 防抖，处理函数本身不等待。"""
+    inline_query, started = update.inline_query, time.monotonic()
+    query_text = inline_query.query
 
     try:
         # 如果用户只输入了@botname，没有附带查询语句
         if not query_text:
-            results.append(
+            results = [
                 InlineQueryResultArticle(
                     id=str(uuid.uuid4()),
                     title="开始输入FOFA查询语法...",
@@ -1451,66 +3240,29 @@ def inline_fofa_handler(update: Update, context: CallbackContext) -> None:
                         parse_mode=ParseMode.MARKDOWN
                     )
                 )
-            )
-            update.inline_query.answer(results, cache_time=300) # 初始消息可以缓存久一点
+            ]
+            answer_inline_query(inline_query, results, cache_time=300) # 初始消息可以缓存久一点
             return
 
-        # --- 用户输入了查询语句，开始调用FOFA API ---
-        def inline_query_logic(key, key_level, proxy_session):
-            return fetch_fofa_data(key, query_text, page_size=10, fields="host,title", proxy_session=proxy_session)
-
-        data, _, _, _, _, error = execute_query_with_fallback(inline_query_logic)
+        # 防抖: 期间同一用户又有新的输入(包括命中缓存的输入)，到期时就直接放弃这次查询，Telegram 只会展示最新一次的应答
+        with _INLINE_LOCK: _INLINE_LATEST[inline_query.from_user.id] = inline_query.id
+        rows = INLINE_RESULTS.get(query_text)
+        if rows is not None:
+            answer_inline_query(inline_query, build_inline_articles(query_text, rows))
+            return
+        context.job_queue.run_once(run_inline_query_job, INLINE_DEBOUNCE, context={'inline_query': inline_query, 'started': started}, name=f"inline_{inline_query.id}")
 
-        # 如果查询出错
-        if error:
-            results.append(
-                InlineQueryResultArticle(
-                    id='error',
-                    title="查询出错",
-                    description=str(error),
-                    input_message_content=InputTextMessageContent(f"FOFA 查询失败: {error}")
-                )
-            )
-        # 如果没有找到结果
-        elif not data or not data.get('results'):
-            results.append(
-                InlineQueryResultArticle(
-                    id='no_results',
-                    title="未找到结果",
-                    description=f"查询: {query_text}",
-                    input_message_content=InputTextMessageContent(f"对于查询 '{query_text}'，FOFA 未返回任何结果。")
-                )
-            )
-        # 成功找到结果
-        else:
-            for result in data['results']:
-                host = result[0] if result and len(result) > 0 else "N/A"
-                title = result[1] if result and len(result) > 1 else "无标题"
-                
-                results.append(
-                    InlineQueryResultArticle(
-                        id=str(uuid.uuid4()),
-                        title=host,
-                        description=title,
-                        input_message_content=InputTextMessageContent(host)
-                    )
-                )
-    
     except Exception as e:
-        # 捕获任何意外的崩溃，并返回错误信息
+        # 捕获任何意外的崩溃，并返回错误信息，确保总能响应Telegram，避免界面卡住
         logger.error(f"内联查询时发生严重错误: {e}", exc_info=True)
-        results = [
+        answer_inline_query(inline_query, [
             InlineQueryResultArticle(
                 id='critical_error',
                 title="机器人内部错误",
                 description="处理您的请求时发生意外错误，请检查日志。",
                 input_message_content=InputTextMessageContent("机器人内部错误，请联系管理员。")
             )
-        ]
-    
-    # 确保总能响应Telegram，避免界面卡住
-    update.inline_query.answer(results, cache_time=10) # 实际查询结果缓存时间短一点
-
+        ])
 
 # --- /batchfind 命令 ---
 BATCH_FEATURES = { "protocol": "协议", "domain": "域名", "os": "操作系统", "server": "服务/组件", "icp": "ICP备案号", "title": "标题", "jarm": "JARM指纹", "cert.issuer.org": "证书颁发组织", "cert.issuer.cn": "证书颁发CN", "cert.subject.org": "证书主体组织", "cert.subject.cn": "证书主体CN" }
@@ -1561,6 +3313,93 @@ def select_batch_features_callback(update: Update, context: CallbackContext):
     keyboard.append([InlineKeyboardButton(all_text, callback_data="batchfeature_all"), InlineKeyboardButton("➡️ 开始分析", callback_data="batchfeature_done")])
     query.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
     return BATCHFIND_STATE_SELECT_FEATURES
+# 批量分析把目标合并为 ip="a" || host="b:port" || ... 的查询，每个查询不超过 BATCHFIND_QUERY_MAX_CHARS 个字符，
+# 每个目标预留 BATCHFIND_ROWS_PER_TARGET 行结果，再按 ip/port/host 字段把返回的行对应回各自的目标。
+BATCHFIND_QUERY_MAX_CHARS, BATCHFIND_ROWS_PER_TARGET = 2000, 20
+BATCHFIND_MAX_WORKERS = 8 # 实际线程数为 min(此值, 有效Key数 x 2)
+BATCHFIND_KEY_FIELDS = ('ip', 'port', 'host')
+
+def batchfind_clause(target):
+    return f'ip="{target}"' if ':' not in target else f'host="{target}"'
+
+def chunk_batchfind_targets(targets, max_chars=BATCHFIND_QUERY_MAX_CHARS):
+    """按合并后查询语句的长度把目标分组。"""
+    chunk, length = [], 0
+    for target in targets:
+        clause_length = len(batchfind_clause(target)) + 4 # " || "
+        if chunk and length + clause_length > max_chars: yield chunk; chunk, length = [], 0
+        chunk.append(target); length += clause_length
+    if chunk: yield chunk
+
+def match_batchfind_rows(chunk, results, fields):
+    """把合并查询返回的行对应回目标，每个目标取第一条匹配的行。ip:port 目标按 host 或 ip:port 匹配，纯 IP 目标按 ip 匹配。"""
+    wanted, matched = {target.lower(): target for target in chunk}, {}
+    ip_at, port_at, host_at = (fields.index(field) for field in BATCHFIND_KEY_FIELDS)
+    for row in results:
+        ip, host = str(row[ip_at]).lower(), str(row[host_at]).split('://', 1)[-1].lower()
+        for key in (host, f"{ip}:{row[port_at]}", ip):
+            target = wanted.get(key)
+            if target and target not in matched: matched[target] = row
+    return matched
+
+# --- 共性特征挖掘 ---
+# 对整批结果的每个特征列做 value_counts，再对各列高频值两两组合统计共现次数(布尔掩码按位与)，
+# 覆盖率达到 BATCH_MINING_MIN_COVERAGE 的单值/组合成为候选查询；对覆盖最多的前 BATCH_MINING_PROBES 个候选
+# 用 size=1 的查询探测全网结果数，按 覆盖率 / log10(全网结果数) 排序，兼顾覆盖面与特异性。
+BATCH_MINING_TOP_VALUES, BATCH_MINING_MIN_COVERAGE, BATCH_MINING_PROBES = 3, 0.05, 10
+
+def fofa_clause(field, value):
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'{field}="{escaped}"'
+
+def mine_batch_features(df, features):
+    """返回 ({特征: [(值, 次数)...]}, [(查询子句元组, 覆盖次数)...])，候选按覆盖次数降序。"""
+    min_support = max(2, math.ceil(len(df) * BATCH_MINING_MIN_COVERAGE))
+    top_values, masks = {}, []
+    for feature in features:
+        column = df[BATCH_FEATURES.get(feature, feature)].fillna('').astype(str).str.strip()
+        counts = column[column != ''].value_counts()
+        top_values[feature] = list(counts.head(BATCH_MINING_TOP_VALUES).items())
+        masks.extend((feature, value, (column == value).to_numpy()) for value, count in top_values[feature] if count >= min_support)
+    candidates = [((fofa_clause(feature, value),), int(mask.sum())) for feature, value, mask in masks]
+    for (feature_a, value_a, mask_a), (feature_b, value_b, mask_b) in itertools.combinations(masks, 2):
+        if feature_a == feature_b: continue
+        support = int((mask_a & mask_b).sum())
+        if support >= min_support: candidates.append(((fofa_clause(feature_a, value_a), fofa_clause(feature_b, value_b)), support))
+    candidates.sort(key=lambda item: (-item[1], len(item[0])))
+    return top_values, candidates
+
+def suggest_batch_queries(candidates, total_rows, key_pool):
+    """并发探测候选查询的全网结果数并排序，返回 [{'query', 'support', 'coverage', 'size', 'score'}]。"""
+    def probe(clauses):
+        query = " && ".join(clauses)
+        data, error = key_pool.query(lambda key, key_level, proxy_session: fetch_fofa_data(key, query, page_size=1, fields="host", proxy_session=proxy_session))
+        return query, (data or {}).get('size') if not error else None
+    selected = candidates[:BATCH_MINING_PROBES]
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCHFIND_MAX_WORKERS, 2 * len(key_pool)))) as executor:
+        probed = list(executor.map(probe, [clauses for clauses, _ in selected]))
+    suggestions = []
+    for (query, size), (_, support) in zip(probed, selected):
+        coverage = support / total_rows
+        # 探测失败的候选不参与特异性排序，只按覆盖率排在最后
+        score = coverage / math.log10(size + 10) if size is not None else 0
+        suggestions.append({'query': query, 'support': support, 'coverage': coverage, 'size': size, 'score': score})
+    return sorted(suggestions, key=lambda item: item['score'], reverse=True)
+
+def format_batch_feature_report(top_values, suggestions, total_rows):
+    lines = [f"🧬 *共性特征分析* \\({total_rows} 个有数据的目标\\)\n"]
+    for feature, values in top_values.items():
+        if not values: continue
+        shown = "; ".join(f"`{escape_markdown_v2_code(value[:40])}` {count / total_rows:.0%}" for value, count in values)
+        lines.append(f"*{escape_markdown_v2(BATCH_FEATURES.get(feature, feature))}*: {shown}")
+    if suggestions:
+        lines.append("\n💡 *建议查询* \\(按覆盖率与特异性排序\\)")
+        for i, item in enumerate(suggestions[:5], 1):
+            size_text = f"全网约 {item['size']:,} 条" if item['size'] is not None else "结果数未知"
+            lines.append(f"{i}\\. `{escape_markdown_v2_code(item['query'])}`\n    覆盖 {item['support']}/{total_rows} \\({item['coverage']:.0%}\\), {escape_markdown_v2(size_text)}")
+    else: lines.append(f"\nℹ️ 没有覆盖率达到 {BATCH_MINING_MIN_COVERAGE:.0%} 的共同特征，无法给出建议查询。")
+    return "\n".join(lines)
+
 def run_batch_find_job(context: CallbackContext):
     job_data = context.job.context; chat_id, file_path, features = job_data['chat_id'], job_data['file_path'], job_data['features']
     bot = context.bot; msg = bot.send_message(chat_id, "⏳ 开始批量分析任务...")
@@ -1568,32 +3407,75 @@ def run_batch_find_job(context: CallbackContext):
         with open(file_path, 'r', encoding='utf-8') as f: targets = [line.strip() for line in f if line.strip()]
     except Exception as e: msg.edit_text(f"❌ 读取文件失败: {e}"); return
     if not targets: msg.edit_text("❌ 文件为空。"); return
-    total_targets = len(targets); processed_count = 0; detailed_results_for_excel = []
-    for target in targets:
-        processed_count += 1
-        if processed_count % 10 == 0:
-            try: msg.edit_text(f"分析进度: {create_progress_bar(processed_count/total_targets*100)} ({processed_count}/{total_targets})")
-            except (BadRequest, RetryAfter, TimedOut): pass
-        query = f'ip="{target}"' if ':' not in target else f'host="{target}"'
-        data, _, _, _, _, error = execute_query_with_fallback(
-            lambda key, key_level, proxy_session: fetch_fofa_data(key, query, page_size=1, fields=",".join(features), proxy_session=proxy_session)
-        )
-        if not error and data.get('results'):
-            result = data['results'][0]
-            row_data = {'Target': target}
-            row_data.update({BATCH_FEATURES.get(f, f): result[i] for i, f in enumerate(features)})
-            detailed_results_for_excel.append(row_data)
-    if detailed_results_for_excel:
-        try:
-            df = pd.DataFrame(detailed_results_for_excel)
-            excel_filename = generate_filename_from_query(os.path.basename(file_path), prefix="analysis", ext=".xlsx")
-            df.to_excel(excel_filename, index=False, engine='openpyxl')
-            msg.edit_text("✅ 分析完成！正在发送Excel报告...")
-            send_file_safely(context, chat_id, excel_filename, caption="📄 详细特征分析Excel报告")
+    total_targets = len(targets)
+    try: local_rows = fetch_indexed_store_rows(lookup_host_index_many(targets), features)
+    except Exception as e: logger.error(f"批量分析查询本地索引失败: {e}"); local_rows = {}
+    remote_targets = list(dict.fromkeys(target for target in targets if target not in local_rows))
+    fields = list(features) + [field for field in BATCHFIND_KEY_FIELDS if field not in features]
+    stop_flag = register_stop_key(context, chat_id, 'batchfind')
+    key_pool = FofaKeyPool([key for key in CONFIG['apis'] if KEY_LEVELS.get(key, -1) >= 0])
+    workers = max(1, min(BATCHFIND_MAX_WORKERS, 2 * len(key_pool)))
+
+    def lookup(chunk):
+        query, page_size = " || ".join(batchfind_clause(target) for target in chunk), 1 if len(chunk) == 1 else min(10000, len(chunk) * BATCHFIND_ROWS_PER_TARGET)
+        data, error = key_pool.query(lambda key, key_level, proxy_session: fetch_fofa_data(key, query, page_size=page_size, fields=",".join(fields), proxy_session=proxy_session))
+        return chunk, data, error
+
+    # 同时在途的分组不超过线程数；结果被截断时，未匹配到的目标对半拆分后重新排队，直到单个目标。
+    # 停止时不再提交新分组，等在途请求返回后用已有结果生成报告。
+    pending, in_flight, remote_rows = deque(chunk_batchfind_targets(remote_targets)), set(), {}
+    processed_count, api_calls, last_update_time, stopped = total_targets - len(remote_targets), 0, 0, False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            stopped = stopped or bool(context.bot_data.get(stop_flag))
+            while pending and not stopped and len(in_flight) < workers: in_flight.add(executor.submit(lookup, pending.popleft()))
+            if not in_flight: break
+            done, in_flight = wait(in_flight, timeout=2, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk, data, error = future.result(); api_calls += 1
+                if error: logger.warning(f"批量分析查询失败 ({len(chunk)} 个目标): {error}"); processed_count += len(chunk); continue
+                results = data.get('results', [])
+                matched = match_batchfind_rows(chunk, results, fields); remote_rows.update(matched)
+                missing = [target for target in chunk if target not in matched]
+                if missing and len(chunk) > 1 and data.get('size', 0) > len(results):
+                    half = (len(missing) + 1) // 2; pending.extend((missing[:half], missing[half:])); processed_count += len(chunk) - len(missing)
+                else: processed_count += len(chunk)
+            if time.time() - last_update_time > 2:
+                try: msg.edit_text(f"分析进度: {create_progress_bar(processed_count/total_targets*100)} ({processed_count}/{total_targets}, API请求 {api_calls} 次, 并发 {workers})")
+                except (BadRequest, RetryAfter, TimedOut): pass
+                last_update_time = time.time()
+    release_stop_key(context, chat_id, stop_flag)
+    # 按上传顺序把每行直接写入流式 xlsx，特征值按列另存一份引用，只用于共性特征挖掘
+    columns = ['Target'] + [BATCH_FEATURES.get(f, f) for f in features] + (['本地来源'] if local_rows else [])
+    feature_values = {BATCH_FEATURES.get(f, f): [] for f in features}
+    excel_filename = generate_filename_from_query(os.path.basename(file_path), prefix="analysis", ext=".xlsx")
+    try:
+        with StreamingTableWriter(excel_filename, columns, 'xlsx') as writer:
+            for target in targets:
+                if target in local_rows: source_query, result = local_rows[target]
+                elif target in remote_rows: source_query, result = "", remote_rows[target]
+                else: continue
+                values = list(result[:len(features)])
+                writer.write_row([target] + values + ([source_query] if local_rows else []))
+                for column, value in zip(feature_values.values(), values): column.append(value)
+        if writer.row_count:
+            msg.edit_text("🌀 任务已停止，正在发送已完成部分的Excel报告..." if stopped else "✅ 分析完成！正在发送Excel报告...")
+            stopped_text = f", 已手动停止, 完成 {processed_count}/{total_targets}" if stopped else ""
+            send_file_safely(context, chat_id, excel_filename, caption=f"📄 详细特征分析Excel报告 (本地索引命中 {len(local_rows)} 个目标, FOFA合并查询 {api_calls} 次{stopped_text})")
             upload_and_send_links(context, chat_id, excel_filename)
-            os.remove(excel_filename)
-        except Exception as e: msg.edit_text(f"❌ 生成Excel失败: {e}")
-    else: msg.edit_text("🤷‍♀️ 分析完成，但未找到任何匹配的FOFA数据。")
+        else: msg.edit_text("🤷‍♀️ 分析完成，但未找到任何匹配的FOFA数据。")
+    except Exception as e: msg.edit_text(f"❌ 生成Excel失败: {e}")
+    finally:
+        if os.path.exists(excel_filename): os.remove(excel_filename)
+    if any(feature_values.values()):
+        try:
+            df = pd.DataFrame(feature_values)
+            top_values, candidates = mine_batch_features(df, features)
+            suggestions = suggest_batch_queries(candidates, len(df), key_pool) if candidates else []
+            report = format_batch_feature_report(top_values, suggestions, len(df))
+            try: bot.send_message(chat_id, report, parse_mode=ParseMode.MARKDOWN_V2)
+            except BadRequest as e: logger.warning(f"共性特征报告格式无效，改为纯文本发送: {e}"); bot.send_message(chat_id, re.sub(r'\\([^\\])', r'\1', report))
+        except Exception as e: logger.error(f"共性特征分析失败: {e}")
     if os.path.exists(file_path): os.remove(file_path)
 
 # --- /batch (交互式) ---
@@ -1659,30 +3541,54 @@ def batch_select_fields_callback(update: Update, context: CallbackContext):
             query.answer("请至少选择一个字段！", show_alert=True)
             return BATCH_STATE_SELECT_FIELDS
         query_text = context.user_data['query']
-        fields_str = ",".join(list(selected_fields))
-        msg = query.message.edit_text("正在执行查询以预估数据量...")
-        data, _, used_key_index, key_level, _, error = execute_query_with_fallback(
-            lambda key, key_level, proxy_session: fetch_fofa_data(key, query_text, page_size=1, fields="host", proxy_session=proxy_session)
-        )
-        if error: msg.edit_text(f"❌ 查询出错: {error}"); return ConversationHandler.END
-        total_size = data.get('size', 0)
-        if total_size == 0: msg.edit_text("🤷‍♀️ 未找到结果。"); return ConversationHandler.END
-        allowed_fields = get_fields_by_level(key_level)
-        unauthorized_fields = [f for f in selected_fields if f not in allowed_fields]
-        if unauthorized_fields:
-            msg.edit_text(f"⚠️ 警告: 您选择的字段 `{', '.join(unauthorized_fields)}` 超出当前可用最高级Key (等级{key_level}) 的权限。请重新选择或升级Key。")
-            return BATCH_STATE_SELECT_FIELDS
-        context.user_data.update({'chat_id': update.effective_chat.id, 'fields': fields_str, 'total_size': total_size, 'is_batch_mode': True })
-        success_message = f"✅ 使用 Key \\[\\#{used_key_index}\\] \\(等级{key_level}\\) 找到 {total_size} 条结果\\."
-        if total_size <= 10000:
-            msg.edit_text(f"{success_message}\n开始自定义字段批量导出\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2); start_download_job(context, run_batch_download_query, context.user_data)
-            return ConversationHandler.END
-        else:
-            keyboard = [[InlineKeyboardButton("💎 导出前1万条", callback_data='mode_full'), InlineKeyboardButton("🌀 深度追溯导出", callback_data='mode_traceback')], [InlineKeyboardButton("❌ 取消", callback_data='mode_cancel')]]
-            msg.edit_text(f"{success_message}\n请选择导出模式:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2); return BATCH_STATE_MODE_CHOICE
+        store_meta = find_columnar_store(query_text, selected_fields)
+        if store_meta:
+            dt_local = datetime.fromisoformat(store_meta['timestamp']).astimezone(tz.tzlocal()).strftime('%Y-%m-%d %H:%M')
+            completeness = "" if store_meta.get('complete', True) else " (不完整)"
+            keyboard = [
+                [InlineKeyboardButton("📄 本地导出 CSV", callback_data='batchlocal_csv'), InlineKeyboardButton("🧾 本地导出 NDJSON", callback_data='batchlocal_ndjson')],
+                [InlineKeyboardButton("📊 本地导出 XLSX", callback_data='batchlocal_xlsx')],
+                [InlineKeyboardButton("🔍 重新下载", callback_data='batchlocal_redownload'), InlineKeyboardButton("❌ 取消", callback_data='batchlocal_cancel')]
+            ]
+            query.message.edit_text(f"📦 发现本地列存 ({store_meta['rows']} 条{completeness}, 缓存于 {dt_local})，已包含所选字段。\n可直接在本地投影导出，无需消耗F点。", reply_markup=InlineKeyboardMarkup(keyboard))
+            return BATCH_STATE_LOCAL_CHOICE
+        return start_remote_batch_export(update, context)
     keyboard = build_batch_fields_keyboard(context.user_data)
     query.message.edit_reply_markup(reply_markup=keyboard)
     return BATCH_STATE_SELECT_FIELDS
+def batch_local_choice_callback(update: Update, context: CallbackContext):
+    query = update.callback_query; query.answer(); choice = query.data.split('_', 1)[1]
+    if choice == 'cancel': query.message.edit_text("操作已取消。"); return ConversationHandler.END
+    if choice == 'redownload': return start_remote_batch_export(update, context)
+    job_context = {'chat_id': update.effective_chat.id, 'query': context.user_data['query'], 'fields': list(context.user_data['selected_fields']), 'fmt': choice}
+    context.job_queue.run_once(run_columnar_export_job, 1, context=job_context, name=f"batchlocal_{update.effective_chat.id}")
+    query.message.edit_text("⏳ 正在从本地列存导出...")
+    return ConversationHandler.END
+def start_remote_batch_export(update: Update, context: CallbackContext):
+    query = update.callback_query
+    selected_fields = context.user_data['selected_fields']
+    query_text = context.user_data['query']
+    fields_str = ",".join(list(selected_fields))
+    msg = query.message.edit_text("正在执行查询以预估数据量...")
+    data, used_key, used_key_index, key_level, _, error = execute_query_with_fallback(
+        lambda key, key_level, proxy_session: fetch_fofa_data(key, query_text, page_size=1, fields="host", proxy_session=proxy_session)
+    )
+    if error: msg.edit_text(f"❌ 查询出错: {error}"); return ConversationHandler.END
+    total_size = data.get('size', 0)
+    if total_size == 0: msg.edit_text("🤷‍♀️ 未找到结果。"); return ConversationHandler.END
+    allowed_fields = get_fields_by_level(key_capability(used_key)['field_level'])
+    unauthorized_fields = [f for f in selected_fields if f not in allowed_fields]
+    if unauthorized_fields:
+        msg.edit_text(f"⚠️ 警告: 您选择的字段 `{', '.join(unauthorized_fields)}` 超出当前可用最高级Key (等级{key_level}) 的权限。请重新选择或升级Key。")
+        return BATCH_STATE_SELECT_FIELDS
+    context.user_data.update({'chat_id': update.effective_chat.id, 'fields': fields_str, 'total_size': total_size, 'is_batch_mode': True })
+    success_message = f"✅ 使用 Key \\[\\#{used_key_index}\\] \\(等级{key_level}\\) 找到 {total_size} 条结果\\."
+    if total_size <= 10000:
+        msg.edit_text(f"{success_message}\n开始自定义字段批量导出\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2); start_download_job(context, run_batch_download_query, context.user_data)
+        return ConversationHandler.END
+    else:
+        keyboard = [[InlineKeyboardButton("💎 导出前1万条", callback_data='mode_full'), InlineKeyboardButton("🌀 深度追溯导出", callback_data='mode_traceback')], [InlineKeyboardButton("❌ 取消", callback_data='mode_cancel')]]
+        msg.edit_text(f"{success_message}\n请选择导出模式:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2); return BATCH_STATE_MODE_CHOICE
 
 # --- /batchcheckapi 命令 ---
 @admin_only
@@ -1792,7 +3698,8 @@ def check_command(update: Update, context: CallbackContext):
 def stop_all_tasks(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     context.bot_data[f'stop_job_{chat_id}'] = True
-    update.message.reply_text("🛑 已发送停止信号，当前下载任务将在完成本页后停止。")
+    for stop_key in list(context.bot_data.get(f'stop_keys_{chat_id}', ())): context.bot_data[stop_key] = True
+    update.message.reply_text("🛑 已发送停止信号，当前下载任务将在完成本页后停止，扫描任务将在在途探测完成后停止并保存断点。")
 @admin_only
 def backup_config_command(update: Update, context: CallbackContext):
     if update.callback_query:
@@ -1838,14 +3745,14 @@ def get_import_query(update: Update, context: CallbackContext):
     file = doc.get_file()
     temp_path = os.path.join(FOFA_CACHE_DIR, f"import_{doc.file_id}.txt")
     file.download(custom_path=temp_path)
-    try:
-        with open(temp_path, 'r', encoding='utf-8') as f: result_count = sum(1 for _ in f)
-    except Exception as e: update.message.reply_text(f"❌ 读取文件失败: {e}"); os.remove(temp_path); return ConversationHandler.END
     query_text = update.message.text
     if not query_text: update.message.reply_text("请输入与此文件关联的原始FOFA查询语法:"); return IMPORT_STATE_GET_FILE
     final_filename = generate_filename_from_query(query_text)
     final_path = os.path.join(FOFA_CACHE_DIR, final_filename)
     shutil.move(temp_path, final_path)
+    # 缓存文件一律在写入时排好序，扫描和集合运算可以直接二分查找
+    try: ensure_sorted_cache(final_path); result_count = count_cache_lines(final_path)
+    except Exception as e: update.message.reply_text(f"❌ 读取文件失败: {e}"); os.remove(final_path); return ConversationHandler.END
     cache_data = {'file_path': final_path, 'result_count': result_count}
     add_or_update_query(query_text, cache_data)
     update.message.reply_text(f"✅ 成功导入缓存！\n查询: `{escape_markdown_v2(query_text)}`\n共 {result_count} 条记录\\.", parse_mode=ParseMode.MARKDOWN_V2)
@@ -2286,6 +4193,8 @@ def run_allfofa_download_job(context: CallbackContext):
     
     stop_flag = f'stop_job_{chat_id}'
     msg = bot.send_message(chat_id, "⏳ 开始使用 `next` 接口进行海量下载...")
+    pipeline = start_download_pipeline(context, job_data, query_text)
+    if pipeline: pipeline.feed(unique_results)
     
     next_id, termination_reason, last_update_time = initial_next_id, "", 0
 
@@ -2314,6 +4223,7 @@ def run_allfofa_download_job(context: CallbackContext):
             break
         
         unique_results.update(res for res in results if isinstance(res, str) and ':' in res)
+        if pipeline: pipeline.feed(res for res in results if isinstance(res, str) and ':' in res)
 
         if limit and len(unique_results) >= limit:
             unique_results = set(list(unique_results)[:limit])
@@ -2334,13 +4244,12 @@ def run_allfofa_download_job(context: CallbackContext):
             termination_reason = "\n\nℹ️ 已获取所有查询结果 (API未返回next_id)."
             break
 
+    if pipeline: pipeline.finish(stopped=bool(context.bot_data.get(stop_flag)))
     if unique_results:
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            f.write("\n".join(sorted(list(unique_results))))
+        cache_path = os.path.join(FOFA_CACHE_DIR, output_filename)
+        write_cache_lines(cache_path, sorted(unique_results))
         
         msg.edit_text(f"✅ 海量下载完成！共 {len(unique_results)} 条。{termination_reason}\n正在发送文件\\.\\.\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        cache_path = os.path.join(FOFA_CACHE_DIR, output_filename)
-        shutil.move(output_filename, cache_path)
         
         send_file_safely(context, chat_id, cache_path, filename=output_filename)
         
@@ -2431,6 +4340,8 @@ def interactive_setup():
 def main() -> None:
     global CONFIG
     os.makedirs(FOFA_CACHE_DIR, exist_ok=True)
+    os.makedirs(COLUMNAR_DIR, exist_ok=True)
+    os.makedirs(SCAN_STATE_DIR, exist_ok=True)
 
     if not os.path.exists(CONFIG_FILE) or CONFIG.get("bot_token") == "YOUR_BOT_TOKEN_HERE":
         if not interactive_setup():
@@ -2446,6 +4357,7 @@ def main() -> None:
                 continue
 
             check_and_classify_keys()
+            threading.Thread(target=backfill_host_index, daemon=True).start()
             updater = Updater(token=bot_token, use_context=True, request_kwargs={'read_timeout': 20, 'connect_timeout': 20})
             break  # Break loop if updater is created successfully
         except InvalidToken:
@@ -2466,7 +4378,9 @@ def main() -> None:
         BotCommand("stats", "📊 全局聚合统计"), BotCommand("batchfind", "📂 批量智能分析 (Excel)"),
         BotCommand("batch", "📤 批量自定义导出 (交互式)"), BotCommand("batchcheckapi", "🔑 批量验证API Key"),
         BotCommand("check", "🩺 系统自检"), BotCommand("settings", "⚙️ 设置菜单"),
-        BotCommand("history", "🕰️ 查询历史"), BotCommand("import", "🖇️ 导入旧缓存"),
+        BotCommand("history", "🕰️ 查询历史"), BotCommand("view", "👁 分页预览缓存"),
+        BotCommand("diff", "➖ 缓存结果差集"), BotCommand("union", "➕ 缓存结果并集"), BotCommand("intersect", "✖️ 缓存结果交集"),
+        BotCommand("import", "🖇️ 导入旧缓存"),
         BotCommand("backup", "📤 备份配置"), BotCommand("restore", "📥 恢复配置"),
         BotCommand("update", "🔄 在线更新脚本"), BotCommand("getlog", "📄 获取日志"),
         BotCommand("shutdown", "🔌 关闭机器人"), BotCommand("stop", "🛑 停止任务"),
@@ -2524,7 +4438,8 @@ def main() -> None:
         states={
             BATCH_STATE_SELECT_FIELDS: [CallbackQueryHandler(batch_select_fields_callback, pattern=r"^batchfield_")],
             BATCH_STATE_MODE_CHOICE: [CallbackQueryHandler(query_mode_callback, pattern=r"^mode_")],
-            BATCH_STATE_GET_LIMIT: [MessageHandler(Filters.text & ~Filters.command, get_traceback_limit), CallbackQueryHandler(get_traceback_limit, pattern=r"^limit_")]
+            BATCH_STATE_GET_LIMIT: [MessageHandler(Filters.text & ~Filters.command, get_traceback_limit), CallbackQueryHandler(get_traceback_limit, pattern=r"^limit_")],
+            BATCH_STATE_LOCAL_CHOICE: [CallbackQueryHandler(batch_local_choice_callback, pattern=r"^batchlocal_")]
         },
         fallbacks=[CommandHandler('cancel', cancel)], conversation_timeout=600,
     )
@@ -2532,10 +4447,10 @@ def main() -> None:
     stats_conv = ConversationHandler(entry_points=[CommandHandler("stats", stats_command)], states={STATS_STATE_GET_QUERY: [MessageHandler(Filters.text & ~Filters.command, get_fofa_stats_query)]}, fallbacks=[CommandHandler("cancel", cancel)], conversation_timeout=300)
     batchfind_conv = ConversationHandler(entry_points=[CommandHandler("batchfind", batchfind_command)], states={BATCHFIND_STATE_GET_FILE: [MessageHandler(Filters.document.mime_type("text/plain"), get_batch_file_handler)], BATCHFIND_STATE_SELECT_FEATURES: [CallbackQueryHandler(select_batch_features_callback, pattern=r"^batchfeature_")]}, fallbacks=[CommandHandler("cancel", cancel)], conversation_timeout=300)
     restore_conv = ConversationHandler(entry_points=[CommandHandler("restore", restore_config_command)], states={RESTORE_STATE_GET_FILE: [MessageHandler(Filters.document, receive_config_file)]}, fallbacks=[CommandHandler("cancel", cancel)], conversation_timeout=300)
-    scan_conv = ConversationHandler(entry_points=[CallbackQueryHandler(start_scan_callback, pattern=r'^start_scan_')], states={SCAN_STATE_GET_CONCURRENCY: [MessageHandler(Filters.text & ~Filters.command, get_concurrency_callback)], SCAN_STATE_GET_TIMEOUT: [MessageHandler(Filters.text & ~Filters.command, get_timeout_callback)]}, fallbacks=[CommandHandler('cancel', cancel)], conversation_timeout=120)
+    scan_conv = ConversationHandler(entry_points=[CallbackQueryHandler(start_scan_callback, pattern=r'^start_scan_')], states={SCAN_STATE_GET_CONCURRENCY: [MessageHandler(Filters.text & ~Filters.command, get_concurrency_callback)], SCAN_STATE_GET_TIMEOUT: [MessageHandler(Filters.text & ~Filters.command, get_timeout_callback)], SCAN_STATE_OPTIONS: [CallbackQueryHandler(scan_options_callback, pattern=r'^scanopt_')]}, fallbacks=[CommandHandler('cancel', cancel)], conversation_timeout=120)
     batch_check_api_conv = ConversationHandler(entry_points=[CommandHandler("batchcheckapi", batch_check_api_command)], states={BATCHCHECKAPI_STATE_GET_FILE: [MessageHandler(Filters.document.mime_type("text/plain"), receive_api_file)]}, fallbacks=[CommandHandler("cancel", cancel)], conversation_timeout=300)
     
-    dispatcher.add_handler(CommandHandler("start", start_command)); dispatcher.add_handler(CommandHandler("help", help_command)); dispatcher.add_handler(CommandHandler("host", host_command)); dispatcher.add_handler(CommandHandler("lowhost", lowhost_command)); dispatcher.add_handler(CommandHandler("check", check_command)); dispatcher.add_handler(CommandHandler("stop", stop_all_tasks)); dispatcher.add_handler(CommandHandler("backup", backup_config_command)); dispatcher.add_handler(CommandHandler("history", history_command)); dispatcher.add_handler(CommandHandler("getlog", get_log_command)); dispatcher.add_handler(CommandHandler("shutdown", shutdown_command)); dispatcher.add_handler(CommandHandler("update", update_script_command)); dispatcher.add_handler(InlineQueryHandler(inline_fofa_handler)); 
+    dispatcher.add_handler(CommandHandler("start", start_command)); dispatcher.add_handler(CommandHandler("help", help_command)); dispatcher.add_handler(CommandHandler("host", host_command)); dispatcher.add_handler(CommandHandler("lowhost", lowhost_command)); dispatcher.add_handler(CommandHandler("check", check_command)); dispatcher.add_handler(CommandHandler("stop", stop_all_tasks)); dispatcher.add_handler(CommandHandler("backup", backup_config_command)); dispatcher.add_handler(CommandHandler("history", history_command)); dispatcher.add_handler(CommandHandler("view", view_command)); dispatcher.add_handler(CallbackQueryHandler(view_page_callback, pattern=r"^view_")); dispatcher.add_handler(CommandHandler(list(SET_OPERATIONS), set_operation_command)); dispatcher.add_handler(CommandHandler("getlog", get_log_command)); dispatcher.add_handler(CommandHandler("shutdown", shutdown_command)); dispatcher.add_handler(CommandHandler("update", update_script_command)); dispatcher.add_handler(InlineQueryHandler(inline_fofa_handler)); 
     
     # --- 主菜单按钮处理器 (v10.9.6) ---
     menu_conv = ConversationHandler(
@@ -2563,5 +4478,29 @@ def main() -> None:
     updater.idle()
     logger.info("Bot has been shut down gracefully.")
 
+def benchmark_probe_backends(probe_count=20000, concurrency=500):
+    """
+    本地基准测试: 对 127.0.0.1 上一个监听端口和一批关闭端口交替探测，
+    分别统计各探测后端每秒完成的探测数。用法: python fofa.py --bench-scan [探测数]
+    """
+    listener = socket.socket(); listener.bind(('127.0.0.1', 0)); listener.listen(1024)
+    open_port = listener.getsockname()[1]
+    def accept_loop():
+        while True:
+            try: listener.accept()[0].close()
+            except OSError: return
+    threading.Thread(target=accept_loop, daemon=True).start()
+    def targets(): return (("127.0.0.1", open_port if i % 2 == 0 else 1 + i % 1000) for i in range(probe_count))
+    for backend in SCAN_PROBE_BACKENDS:
+        started = time.perf_counter()
+        hits = asyncio.run(async_scanner_orchestrator(targets(), concurrency, 2, backend=backend))
+        elapsed = time.perf_counter() - started
+        print(f"{backend:>8}: {probe_count} 次探测 {elapsed:.2f}s, {probe_count / elapsed:,.0f} 次/秒, 命中 {len(hits)}")
+    listener.close()
+
 if __name__ == "__main__":
-    main()
+    multiprocessing.freeze_support() # PyInstaller 打包后子进程扫描需要
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench-scan':
+        benchmark_probe_backends(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+    else:
+        main()